@@ -0,0 +1,19 @@
+#!/usr/bin/env bash
+# starts one tor, circus and (with BROKER_SOCKET) broker process per socks_port:control_port entry in TOR_INSTANCES
+
+INSTANCES=(${TOR_INSTANCES//,/ })
+
+for instance in "${INSTANCES[@]}"; do
+    socks_port=${instance%%:*}
+    control_port=${instance##*:}
+    tor -f /etc/tor/torrc SocksPort $socks_port ControlPort $control_port DataDirectory $STATE_DIR/tor-$control_port &
+done
+
+sleep 20s
+cd /app/
+
+for i in "${!INSTANCES[@]}"; do
+    python3 circus.py $i &
+    # tova talks to the control ports directly unless BROKER_SOCKET is set
+    [ -n "$BROKER_SOCKET" ] && python3 broker.py $i &
+done
@@ -0,0 +1,239 @@
+import json
+import os
+import random
+import socket
+import sys
+from collections import namedtuple
+from socketserver import ThreadingUnixStreamServer, StreamRequestHandler
+from threading import Lock, Thread
+from time import time, sleep
+from typing import List, Set
+
+from UltraDict import UltraDict
+from stem import SocketError, InvalidArguments, InvalidRequest, ControllerError, StreamStatus, CircStatus, DescriptorUnavailable
+from stem.control import Controller, EventType
+from stem.response.events import CircuitEvent, StreamEvent
+
+from ctrl_metrics import instrument
+from env import CIRCUIT_TTL, BROKER_SOCKET, TOR_INSTANCES, METRICS_INTERVAL, LOG_DIR
+
+RESYNC_INTERVAL = 30
+# closed streams stay visible for a while, so pollers still see the exit's answer of short-lived streams
+CLOSED_LINGER = 5
+
+Stream = namedtuple("Stream", ["id", "status", "target_address", "circ_id"])
+Circuit = namedtuple("Circuit", ["id", "status", "path", "purpose"])
+Relay = namedtuple("Relay", ["fingerprint", "address"])
+
+ERRORS = {"InvalidArguments": InvalidArguments, "InvalidRequest": InvalidRequest, "IndexError": IndexError, "ValueError": ValueError}
+
+circuits = {}
+streams = {}
+closed_streams = {}
+addresses = {}
+cache_lock = Lock()
+ctrl = None
+created = None
+control_port = 0
+
+
+class BrokerController:
+    def __init__(self, path: str):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.file = self.sock.makefile("rwb")
+        self.lock = Lock()
+
+    def authenticate(self):
+        pass
+
+    def batch(self, ops: List[dict]) -> List[dict]:
+        # one round trip for all ops, their results are taken apart with unpack
+        with self.lock:
+            self.file.write((json.dumps(ops) + "\n").encode())
+            self.file.flush()
+            line = self.file.readline()
+        if not line:
+            raise SocketError("broker closed the connection")
+        return json.loads(line)
+
+    def call(self, op: str, **kwargs):
+        return unpack(self.batch([{"op": op, **kwargs}])[0])
+
+    def get_streams(self) -> List[Stream]:
+        return [Stream(**stream) for stream in self.call("streams")]
+
+    def get_circuits(self) -> List[Circuit]:
+        return [Circuit(**circ) for circ in self.call("circuits")]
+
+    def get_circuit(self, circ_id: str) -> Circuit:
+        return Circuit(**self.call("circuit", circ=circ_id))
+
+    def get_network_status(self, fingerprint: str) -> Relay:
+        return Relay(fingerprint, self.call("address", fingerprint=fingerprint))
+
+    def attach_stream(self, stream_id: str, circ_id: str):
+        self.call("attach", stream=stream_id, circ=circ_id)
+
+    def close_stream(self, stream_id: str):
+        self.call("close_stream", stream=stream_id)
+
+
+def unpack(result: dict):
+    if "error" in result:
+        raise ERRORS.get(result["error"], ControllerError)(result["message"])
+    return result["result"]
+
+
+class BrokerHandler(StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                results = execute_batch(json.loads(line))
+            except (ValueError, TypeError) as e:
+                results = [{"error": e.__class__.__name__, "message": str(e)}]
+            self.wfile.write((json.dumps(results) + "\n").encode())
+
+
+def execute_batch(ops: List[dict]) -> List[dict]:
+    leased = set()
+    results = []
+    for op in ops:
+        try:
+            if op["op"] == "lease":
+                result = lease(op["stream"], set(op.get("exclude", [])) | leased)
+                leased.add(result["circ"])
+            else:
+                result = execute(op)
+            results.append({"result": result})
+        except Exception as e:
+            results.append({"error": e.__class__.__name__, "message": str(e)})
+    return results
+
+
+def execute(op: dict):
+    if op["op"] == "streams":
+        with cache_lock:
+            return list(streams.values())
+    elif op["op"] == "circuits":
+        with cache_lock:
+            return list(circuits.values())
+    elif op["op"] == "circuit":
+        with cache_lock:
+            return circuits[op["circ"]]
+    elif op["op"] == "address":
+        return address_of(op["fingerprint"])
+    elif op["op"] == "attach":
+        ctrl.attach_stream(op["stream"], op["circ"])
+    elif op["op"] == "close_stream":
+        ctrl.close_stream(op["stream"])
+    else:
+        raise InvalidRequest(f"unknown op {op['op']}")
+
+
+def lease(stream_id: str, exclude: Set[str]) -> dict:
+    with cache_lock:
+        available_circs = [circ for circ in circuits.values() if circ["status"] == "BUILT" and len(circ["path"]) > 1 and circ["id"] not in exclude and created.get(circ["id"], 0) + CIRCUIT_TTL > time()]
+    circ = random.choice(available_circs)
+    ctrl.attach_stream(stream_id, circ["id"])
+    return {"circ": circ["id"], "exit": address_of(circ["path"][-1][0])}
+
+
+def address_of(fingerprint: str) -> str:
+    with cache_lock:
+        if fingerprint in addresses:
+            return addresses[fingerprint]
+    try:
+        address = ctrl.get_network_status(fingerprint).address
+    except (ValueError, DescriptorUnavailable):
+        return "0.0.0.0"
+    with cache_lock:
+        addresses[fingerprint] = address
+    return address
+
+
+def circuit_state(circ: CircuitEvent) -> dict:
+    return {"id": circ.id, "status": circ.status, "path": [list(hop) for hop in circ.path], "purpose": circ.purpose}
+
+
+def stream_state(stream: StreamEvent) -> dict:
+    return {"id": stream.id, "status": stream.status, "target_address": stream.target_address, "circ_id": stream.circ_id}
+
+
+def on_circuit(event: CircuitEvent):
+    with cache_lock:
+        if event.status in (CircStatus.FAILED, CircStatus.CLOSED):
+            circuits.pop(event.id, None)
+        else:
+            circuits[event.id] = circuit_state(event)
+
+
+def on_stream(event: StreamEvent):
+    with cache_lock:
+        if event.status == StreamStatus.CLOSED:
+            if event.id in streams:
+                streams[event.id] = {**streams[event.id], "status": event.status}
+                closed_streams[event.id] = time()
+        else:
+            streams[event.id] = stream_state(event)
+        for stream_id, closed in list(closed_streams.items()):
+            if closed + CLOSED_LINGER < time():
+                streams.pop(stream_id, None)
+                del closed_streams[stream_id]
+
+
+def resync():
+    while True:
+        try:
+            current_circuits = {circ.id: circuit_state(circ) for circ in ctrl.get_circuits()}
+            current_streams = {stream.id: stream_state(stream) for stream in ctrl.get_streams()}
+            with cache_lock:
+                circuits.clear()
+                circuits.update(current_circuits)
+                streams.clear()
+                streams.update(current_streams)
+                closed_streams.clear()
+                addresses.clear()
+        except ControllerError as e:
+            log(error=f"resync failed: {e.__class__}")
+        sleep(RESYNC_INTERVAL)
+
+
+def socket_path(control_port: int) -> str:
+    return f"{BROKER_SOCKET}.{control_port}"
+
+
+def log(**data):
+    with open(f"{LOG_DIR}/broker-{control_port}.log", "a") as f:
+        data = {k: list(v) if isinstance(v, set) else v for k, v in data.items()}
+        f.write(json.dumps(data) + "\n")
+
+
+def main():
+    global ctrl, created, control_port
+
+    _, control_port = TOR_INSTANCES[int(sys.argv[1]) if len(sys.argv) > 1 else 0]
+    while True:
+        try:
+            ctrl = instrument(Controller.from_port(port=control_port), process=f"broker-{control_port}", interval=METRICS_INTERVAL, log_dir=LOG_DIR)
+            break
+        except SocketError:
+            sleep(2)
+    ctrl.authenticate()
+    created = UltraDict(name=f"circuit_creation_{control_port}")
+
+    ctrl.add_event_listener(on_circuit, EventType.CIRC)
+    ctrl.add_event_listener(on_stream, EventType.STREAM)
+    Thread(target=resync, daemon=True).start()
+
+    path = socket_path(control_port)
+    if os.path.exists(path):
+        os.remove(path)
+    with ThreadingUnixStreamServer(path, BrokerHandler) as server:
+        server.daemon_threads = True
+        log(listening=path)
+        server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,9 @@
 import json
 import random
+import sys
 from ipaddress import IPv4Network
 from math import ceil
+from threading import Lock
 from time import sleep, time
 from typing import Set, List, Tuple, Union, Optional
 
@@ -9,20 +11,35 @@ import requests
 from UltraDict import UltraDict
 from requests import ConnectionError
 from stem import SocketError, InvalidArguments, Flag, InvalidRequest, CircuitExtensionFailed, DescriptorUnavailable
-from stem import Timeout
-from stem.control import Controller
+from stem import Timeout, CircStatus
+from stem.control import Controller, EventType
 from stem.descriptor.router_status_entry import RouterStatusEntry
 from stem.response.events import CircuitEvent
 
-from env import CIRCUIT_TTL, PREFIX_LEN, N_CIRCUITS, VAL_K, BUILD_INTERVAL
+from ctrl_metrics import instrument
+from env import CIRCUIT_TTL, PREFIX_LEN, N_CIRCUITS, VAL_K, BUILD_INTERVAL, STATE_DIR, SNAPSHOT_INTERVAL, SNAPSHOT_MAX_AGE, TOR_INSTANCES, METRICS_INTERVAL, LOG_DIR
+from snapshot import save_snapshot, load_snapshot, good_paths, prune_health
 
-created = UltraDict({}, name="circuit_creation", buffer_size=8192, auto_unlink=True)
-subnets = set()
+SOCKS_PORT, CONTROL_PORT = TOR_INSTANCES[int(sys.argv[1]) if len(sys.argv) > 1 else 0]
+
+created = UltraDict({}, name=f"circuit_creation_{CONTROL_PORT}", buffer_size=8192, auto_unlink=True)
+# exit subnets in use, shared by the circus processes of all tor instances
+subnets = UltraDict({}, name="exit_subnets", buffer_size=8192 * len(TOR_INSTANCES), shared_lock=True)
 host_ip = ""
 
+relay_index = {"guards": [], "exits": []}
+path_of = {}
+# exit subnet claimed by each circuit, tor no longer knows the exit of circuits that failed or closed
+subnet_of_circ = {}
+# held while a circuit is launched, so its CIRC events (delivered on stem's event thread) wait until its path is recorded
+path_lock = Lock()
+health = {}
+health_lock = Lock()
+SNAPSHOT_FILE = f"{STATE_DIR}/circus-{CONTROL_PORT}.json"
+
 while True:
     try:
-        ctrl = Controller.from_port()
+        ctrl = instrument(Controller.from_port(port=CONTROL_PORT), process=f"circus-{CONTROL_PORT}", interval=METRICS_INTERVAL, log_dir=LOG_DIR)
         break
     except SocketError:
         sleep(2)
@@ -54,10 +71,11 @@ def expire_circuits(circuits: List[str]) -> int:
     closed = 0
     for circ_id in circuits:
         if circ_id not in open_streams():
-            try:
-                subnets.remove(subnet_of(exit_ip_of(circ_id)))
-            except KeyError:
-                pass
+            with path_lock:
+                path_of.pop(circ_id, None)
+                subnet = subnet_of_circ.pop(circ_id, None)
+            if subnet:
+                release_subnet(subnet)
             try:
                 ctrl.close_circuit(circ_id)
             except InvalidArguments:
@@ -83,6 +101,7 @@ def get_relays() -> Tuple[List[RouterStatusEntry], List[RouterStatusEntry]]:
 
             exits = {relay for relay in relays if Flag.EXIT in relay.flags and Flag.BADEXIT not in relay.flags and Flag.RUNNING in relay.flags}
             guards = {relay for relay in relays - exits if Flag.GUARD in relay.flags and Flag.FAST in relay.flags and Flag.RUNNING in relay.flags}
+            relay_index.update(guards=list(guards), exits=list(exits))
             return list(guards), list(exits)
 
         except DescriptorUnavailable:
@@ -97,26 +116,83 @@ def build_circuits(guards: List[RouterStatusEntry], exits: List[RouterStatusEntr
     paths = set()
     while len(paths) < n and len(exits) > 0:
         exit = random.choice(exits)
-        subnet = subnet_of(exit.address)
-        if subnet not in subnets:
+        if claim_subnet(exit.address):
             guard = random.choices(guards, weights=guard_weights, k=1)[0]
-            paths.add((guard.fingerprint, exit.fingerprint))
-            subnets.add(subnet)
+            paths.add((guard.fingerprint, exit.fingerprint, str(subnet_of(exit.address))))
         exits.remove(exit)
 
-    for path in paths:
-        build_circuit(list(path))
+    for guard, exit, subnet in paths:
+        if build_circuit([guard, exit], subnet) == -1:
+            release_subnet(subnet)
 
 
-def build_circuit(path: List[str]) -> int:
+def build_circuit(path: List[str], subnet: str) -> int:
     try:
-        circ_id = ctrl.new_circuit(path, await_build=False)
+        with path_lock:
+            circ_id = ctrl.new_circuit(path, await_build=False)
+            path_of[circ_id] = tuple(path)
+            subnet_of_circ[circ_id] = subnet
         created[circ_id] = time()
         return circ_id
     except (InvalidRequest, CircuitExtensionFailed, Timeout):
         return -1
 
 
+def build_known_paths(paths: List[Tuple[str, str]], exits: List[RouterStatusEntry], n: int) -> int:
+    address_of = {relay.fingerprint: relay.address for relay in exits}
+    built = 0
+    for guard, exit in paths:
+        if built >= n:
+            break
+        if exit not in address_of or not claim_subnet(address_of[exit]):
+            continue
+        subnet = str(subnet_of(address_of[exit]))
+        if build_circuit([guard, exit], subnet) != -1:
+            built += 1
+        else:
+            release_subnet(subnet)
+    return built
+
+
+def claim_subnet(ip: str) -> bool:
+    # test and set under the lock shared by the circus processes of all tor instances
+    subnet = str(subnet_of(ip))
+    with subnets.lock:
+        if subnet in subnets:
+            return False
+        subnets[subnet] = CONTROL_PORT
+        return True
+
+
+def release_subnet(subnet: str):
+    with subnets.lock:
+        subnets.pop(subnet, None)
+
+
+def track_health(event: CircuitEvent):
+    if event.status not in (CircStatus.BUILT, CircStatus.FAILED):
+        return
+    with path_lock:
+        if event.id not in path_of:
+            return
+        path = path_of[event.id] if event.status == CircStatus.BUILT else path_of.pop(event.id)
+
+    with health_lock:
+        stats = health.setdefault(path, {"built": 0, "failed": 0, "last_built": 0})
+        if event.status == CircStatus.BUILT:
+            stats["built"] += 1
+            stats["last_built"] = time()
+        else:
+            stats["failed"] += 1
+
+
+def store_snapshot():
+    global health
+    with health_lock:
+        health = prune_health(health, relay_index["guards"], relay_index["exits"], max_paths=4 * N_CIRCUITS)
+        save_snapshot(SNAPSHOT_FILE, relay_index["guards"], relay_index["exits"], health)
+
+
 def weight_guards(guards: List[RouterStatusEntry]) -> List[int]:
     if host_ip:
         return [guard.bandwidth * ceil(network_overlap(host_ip, guard.address)) for guard in guards]
@@ -162,7 +238,7 @@ def get_ip() -> str:
 
 
 def log(**data):
-    with open("/app/logs/circus.log", "a") as f:
+    with open(f"{LOG_DIR}/circus-{CONTROL_PORT}.log", "a") as f:
         data = {k: list(v) if isinstance(v, set) else v for k, v in data.items()}
         f.write(json.dumps(data) + "\n")
 
@@ -171,19 +247,42 @@ def main():
     host_ip = get_ip()
     log(ip=host_ip if host_ip else None)
 
+    ctrl.add_event_listener(track_health, EventType.CIRC)
+    with subnets.lock:
+        for subnet, port in list(subnets.items()):
+            if port == CONTROL_PORT:
+                del subnets[subnet]
+
     log(to_build=N_CIRCUITS)
     guards, exits = set(), set()
+    snapshot = load_snapshot(SNAPSHOT_FILE, max_age=SNAPSHOT_MAX_AGE)
+    if snapshot:
+        guards, exits, known_health = snapshot
+        health.update(known_health)
+        log(snapshot=SNAPSHOT_FILE, paths=len(known_health))
+        # the snapshot's relays may be up to SNAPSHOT_MAX_AGE old, tor's current ones are used once it has them
+        new_guards, new_exits = get_relays()
+        guards = new_guards if new_guards else guards
+        exits = new_exits if new_exits else exits
+        relay_index.update(guards=list(guards), exits=list(exits))
     while not exits and not guards:
         guards, exits = get_relays()
         sleep(2)
     log(guards=len(guards), exits=len(exits))
 
-    for _ in range(0, N_CIRCUITS, VAL_K):
+    built = build_known_paths(good_paths(health), exits, n=N_CIRCUITS)
+    log(warm_start=built)
+
+    for _ in range(built, N_CIRCUITS, VAL_K):
         build_circuits(guards, exits, VAL_K)
         sleep(BUILD_INTERVAL)
 
+    last_snapshot = time()
     while True:
         guards, exits = renew_circuits(guards, exits)
+        if time() > last_snapshot + SNAPSHOT_INTERVAL:
+            store_snapshot()
+            last_snapshot = time()
         sleep(BUILD_INTERVAL)
 
 
@@ -0,0 +1,106 @@
+import json
+import os
+from glob import glob
+from bisect import bisect_left
+from threading import Lock, Thread
+from time import perf_counter, time, sleep
+from typing import List
+
+# upper bounds (seconds) of the latency histogram buckets, last bucket is everything above
+BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+# bytes read from the end of an export to find its latest snapshot
+EXPORT_TAIL = 65536
+
+
+class ControllerMetrics:
+    def __init__(self):
+        self.lock = Lock()
+        self.methods = {}
+
+    def record(self, method: str, duration: float, error: str = None):
+        with self.lock:
+            stats = self.methods.setdefault(method, {"calls": 0, "errors": {}, "total": 0.0, "max": 0.0, "hist": [0] * (len(BUCKETS) + 1)})
+            stats["calls"] += 1
+            stats["total"] += duration
+            stats["max"] = max(stats["max"], duration)
+            stats["hist"][bisect_left(BUCKETS, duration)] += 1
+            if error:
+                stats["errors"][error] = stats["errors"].get(error, 0) + 1
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            methods = {method: {**stats, "errors": dict(stats["errors"]), "hist": list(stats["hist"])} for method, stats in self.methods.items()}
+        return {"time": time(), "pid": os.getpid(), "process": process_name, "buckets": BUCKETS, "methods": methods}
+
+
+class InstrumentedController:
+    def __init__(self, ctrl):
+        self._ctrl = ctrl
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._ctrl, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+
+        def timed(*args, **kwargs):
+            start = perf_counter()
+            try:
+                result = attr(*args, **kwargs)
+            except Exception as e:
+                metrics.record(name, perf_counter() - start, error=e.__class__.__name__)
+                raise
+            metrics.record(name, perf_counter() - start)
+            return result
+
+        return timed
+
+
+metrics = ControllerMetrics()
+process_name = ""
+exporter = None
+
+
+def instrument(ctrl, process: str, interval: int, log_dir: str = "/app/logs") -> InstrumentedController:
+    global process_name, exporter
+
+    process_name = process
+    if interval > 0 and exporter is None:
+        exporter = Thread(target=export_metrics, args=(f"{log_dir}/ctrl-{process}-{os.getpid()}.jsonl", interval), daemon=True)
+        exporter.start()
+    return InstrumentedController(ctrl)
+
+
+def export_metrics(filename: str, interval: int):
+    while True:
+        sleep(interval)
+        with open(filename, "a") as f:
+            f.write(json.dumps(metrics.snapshot()) + "\n")
+
+
+def exported_snapshots(log_dir: str, process: str, max_age: float) -> List[dict]:
+    # latest export of every other process of that name, exports of exited processes stop being updated and are skipped
+    snapshots = []
+    for filename in glob(f"{log_dir}/ctrl-{process}-*.jsonl"):
+        try:
+            with open(filename, "rb") as f:
+                f.seek(max(0, f.seek(0, os.SEEK_END) - EXPORT_TAIL))
+                snapshot = json.loads(f.read().splitlines()[-1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if snapshot["pid"] != os.getpid() and snapshot["time"] + max_age > time():
+            snapshots.append(snapshot)
+    return snapshots
+
+
+def merge_snapshots(snapshots: List[dict]) -> dict:
+    methods = {}
+    for snapshot in snapshots:
+        for method, stats in snapshot["methods"].items():
+            merged = methods.setdefault(method, {"calls": 0, "errors": {}, "total": 0.0, "max": 0.0, "hist": [0] * (len(BUCKETS) + 1)})
+            merged["calls"] += stats["calls"]
+            merged["total"] += stats["total"]
+            merged["max"] = max(merged["max"], stats["max"])
+            merged["hist"] = [a + b for a, b in zip(merged["hist"], stats["hist"])]
+            for error, count in stats["errors"].items():
+                merged["errors"][error] = merged["errors"].get(error, 0) + count
+    return {"time": time(), "pids": sorted(snapshot["pid"] for snapshot in snapshots), "process": process_name, "buckets": BUCKETS, "methods": methods}
@@ -8,6 +8,13 @@ try:
     N_CIRCUITS = int(os.environ["N_CIRCUITS"])
     PREFIX_LEN = int(os.environ["PREFIX_LEN"])
     BUILD_INTERVAL = int(os.environ["BUILD_INTERVAL"])
+    STATE_DIR = os.environ["STATE_DIR"]
+    SNAPSHOT_INTERVAL = int(os.environ["SNAPSHOT_INTERVAL"])
+    SNAPSHOT_MAX_AGE = int(os.environ["SNAPSHOT_MAX_AGE"])
+    BROKER_SOCKET = os.environ["BROKER_SOCKET"]
+    METRICS_INTERVAL = int(os.environ["METRICS_INTERVAL"])
+    LOG_DIR = os.environ["LOG_DIR"]
+    TOR_INSTANCES = [tuple(int(port) for port in instance.split(":")) for instance in os.environ["TOR_INSTANCES"].split(",")]
 
 except KeyError as e:
     print(f"missing env var: {e.args[0]}")
@@ -6,8 +6,10 @@ import requests
 from stem import Flag, Timeout, CircuitExtensionFailed, InvalidRequest, InvalidArguments
 from stem.control import Controller
 
+from ctrl_metrics import instrument
+
 print("setting up")
-ctrl = Controller.from_port()
+ctrl = instrument(Controller.from_port(), process="measure_tor_dns", interval=60)
 ctrl.authenticate()
 
 print("closing existing circuits")
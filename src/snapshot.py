@@ -0,0 +1,48 @@
+import json
+import os
+from time import time
+from typing import List, Tuple, Dict, Optional
+
+from stem.descriptor.router_status_entry import RouterStatusEntry, RouterStatusEntryV3
+
+CircuitPath = Tuple[str, str]
+
+
+def save_snapshot(filename: str, guards: List[RouterStatusEntry], exits: List[RouterStatusEntry], health: Dict[CircuitPath, dict]):
+    snapshot = {"timestamp": time(),
+                "guards": [str(relay) for relay in guards],
+                "exits": [str(relay) for relay in exits],
+                "paths": [{"guard": guard, "exit": exit, **stats} for (guard, exit), stats in health.items()]}
+
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename + ".tmp", "w") as f:
+        json.dump(snapshot, f)
+    os.replace(filename + ".tmp", filename)
+
+
+def load_snapshot(filename: str, max_age: int) -> Optional[Tuple[List[RouterStatusEntry], List[RouterStatusEntry], Dict[CircuitPath, dict]]]:
+    try:
+        with open(filename) as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if time() > snapshot.get("timestamp", 0) + max_age:
+        return None
+
+    guards = [RouterStatusEntryV3(content, validate=False) for content in snapshot["guards"]]
+    exits = [RouterStatusEntryV3(content, validate=False) for content in snapshot["exits"]]
+    health = {(path.pop("guard"), path.pop("exit")): path for path in snapshot["paths"]}
+    return guards, exits, health
+
+
+def good_paths(health: Dict[CircuitPath, dict], min_success: float = 0.5) -> List[CircuitPath]:
+    scored = [(stats["built"] / (stats["built"] + stats["failed"]), stats["last_built"], path) for path, stats in health.items() if stats["built"] > 0]
+    return [path for success, _, path in sorted(scored, reverse=True) if success >= min_success]
+
+
+def prune_health(health: Dict[CircuitPath, dict], guards: List[RouterStatusEntry], exits: List[RouterStatusEntry], max_paths: int) -> Dict[CircuitPath, dict]:
+    guard_fps = {relay.fingerprint for relay in guards}
+    exit_fps = {relay.fingerprint for relay in exits}
+    known = {path: stats for path, stats in health.items() if path[0] in guard_fps and path[1] in exit_fps}
+    return dict(sorted(known.items(), key=lambda x: (x[1]["built"] - x[1]["failed"], x[1]["last_built"]), reverse=True)[:max_paths])
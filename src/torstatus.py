@@ -1,9 +1,18 @@
 #!/usr/bin/env python3
+import sys
+
 from stem.control import Controller
 
+from ctrl_metrics import instrument
+from env import TOR_INSTANCES, METRICS_INTERVAL, LOG_DIR
+
+# index of the tor instance in TOR_INSTANCES, like circus.py
+SOCKS_PORT, CONTROL_PORT = TOR_INSTANCES[int(sys.argv[1]) if len(sys.argv) > 1 else 0]
+
 
 def main():
-    with Controller.from_port() as ctrl:
+    with Controller.from_port(port=CONTROL_PORT) as controller:
+        ctrl = instrument(controller, process=f"torstatus-{CONTROL_PORT}", interval=METRICS_INTERVAL, log_dir=LOG_DIR)
         ctrl.authenticate()
 
         for circuit in ctrl.get_circuits():
@@ -2,10 +2,12 @@ import json
 import os
 import random
 import re
+from collections import namedtuple
 from concurrent.futures import ThreadPoolExecutor, TimeoutError
 from ipaddress import IPv4Network
+from itertools import cycle, islice
 from time import time, sleep
-from typing import Union, Set
+from typing import Union, Set, Tuple, List
 
 import requests
 from UltraDict import UltraDict
@@ -14,7 +16,11 @@ from stem import StreamStatus, SocketError, InvalidArguments, InvalidRequest
 from stem.control import Controller
 from stem.response.events import CircuitEvent
 
-from env import REQUEST_TIMEOUT, VAL_N, VAL_K, PREFIX_LEN, CIRCUIT_TTL
+from broker import BrokerController, socket_path, unpack
+from ctrl_metrics import instrument, metrics, exported_snapshots, merge_snapshots
+from env import REQUEST_TIMEOUT, VAL_N, VAL_K, PREFIX_LEN, CIRCUIT_TTL, BROKER_SOCKET, TOR_INSTANCES, METRICS_INTERVAL, LOG_DIR
+
+TorInstance = namedtuple("TorInstance", ["ctrl", "sess", "created"])
 
 app = Flask(__name__)
 
@@ -29,26 +35,35 @@ def https_acme_proxy(domain: str, challenge: str):
     return acme_proxy("https", domain, challenge)
 
 
+@app.route("/metrics/ctrl")
+def ctrl_metrics():
+    # each gunicorn worker only has its own metrics, the other workers' are taken from their latest export (none if METRICS_INTERVAL is 0)
+    snapshots = [metrics.snapshot()] + exported_snapshots(LOG_DIR, "tova", max_age=2 * METRICS_INTERVAL)
+    return merge_snapshots(snapshots)
+
+
 def acme_proxy(protocol: str, domain: str, challenge: str):
     req_start = time()
 
     votes = {}
     results = []
     current_circuits = set()
-    stream_exits, target_exits = {}, {}
+    stream_exits = {}
     url = f"{protocol}://{domain}/{challenge}"
     futures = []
+    tor = next(instances)
 
     while True:
         n_threads = VAL_K - max_votes(votes)
+        target_exits = {}
         with ThreadPoolExecutor(n_threads) as pool:
-            #futures += [pool.submit(get, url) for _ in range(n_threads)]
+            #futures += [pool.submit(get, tor.sess, url) for _ in range(n_threads)]
             for _ in range(n_threads):
-                future = pool.submit(get, url)
+                future = pool.submit(get, tor.sess, url)
                 stream_id = 0
                 while stream_id == 0:
                     sleep(0.1)
-                    stream_ids = {stream.id for stream in ctrl.get_streams() if stream.status == StreamStatus.NEW and stream.target_address == domain}
+                    stream_ids = {stream.id for stream in tor.ctrl.get_streams() if stream.status == StreamStatus.NEW and stream.target_address == domain}
                     new_stream_ids = sorted(stream_ids - {stream_id for stream_id, _ in futures})
                     stream_id = new_stream_ids[-1] if len(new_stream_ids) > 0 else 0
                 futures.append((stream_id, future))
@@ -56,31 +71,35 @@ def acme_proxy(protocol: str, domain: str, challenge: str):
             t = time()
             while len(target_exits) < n_threads and time() < t + REQUEST_TIMEOUT:
                 try:
-                    for stream in ctrl.get_streams():
+                    new_streams, detached_streams = [], []
+                    for stream in tor.ctrl.get_streams():
                         if stream.status == StreamStatus.NEW and stream.target_address == domain:
-                            while True:
-                                available_circs = [circ for circ in ctrl.get_circuits() if circ.status == "BUILT" and len(circ.path) > 1 and circ.id not in current_circuits and created.get(circ.id, 0) + CIRCUIT_TTL > time()]
-                                try:
-                                    circ = random.choice(available_circs)
-                                    ctrl.attach_stream(stream.id, circ.id)
-                                    stream_exits[stream.id] = exit_ip_of(circ)
-                                    current_circuits.add(circ.id)
-                                    if not created.get(circ.id):
-                                        created[circ.id] = time()
-                                    break
-
-                                except (InvalidArguments, InvalidRequest):
-                                    n_threads -= 1
-                                    break
-                                except IndexError:
-                                    sleep(0.5)
-                                except:
-                                    sleep(0.1)
-
+                            new_streams.append(stream.id)
                         elif any(stream.status == status for status in [StreamStatus.SUCCEEDED, StreamStatus.FAILED, StreamStatus.DETACHED, StreamStatus.CLOSED]) and stream_exits.get(stream.id):
                             target_exits[stream_exits[stream.id]] = stream.target_address
                             if stream.status == StreamStatus.DETACHED:
-                                ctrl.close_stream(stream.id)
+                                detached_streams.append(stream.id)
+
+                    if BROKER_SOCKET:
+                        n_threads -= lease_batch(tor, new_streams, detached_streams, current_circuits, stream_exits)
+                        continue
+
+                    for stream_id in new_streams:
+                        while True:
+                            try:
+                                circ_id, stream_exits[stream_id] = lease_circuit(tor, stream_id, current_circuits)
+                                add_lease(tor, circ_id, current_circuits)
+                                break
+
+                            except (InvalidArguments, InvalidRequest):
+                                n_threads -= 1
+                                break
+                            except IndexError:
+                                sleep(0.5)
+                            except:
+                                sleep(0.1)
+                    for stream_id in detached_streams:
+                        tor.ctrl.close_stream(stream_id)
                 except:
                     sleep(0.1)
 
@@ -90,9 +109,10 @@ def acme_proxy(protocol: str, domain: str, challenge: str):
                     try:
                         result = brev(future.result(timeout=1))
                         futures.remove((stream_id, future))
-                        results.append((stream_exits[stream_id], target_exits.get(stream_exits[stream_id]), result))
+                        exit_ip = stream_exits.get(stream_id, "0.0.0.0")
+                        results.append((exit_ip, target_exits.get(exit_ip), result))
                         votes[result] = votes.setdefault(result, 0) + 1
-                    except (TimeoutError, KeyError):
+                    except TimeoutError:
                         pass
 
         if max_votes(votes) >= VAL_K:
@@ -102,19 +122,56 @@ def acme_proxy(protocol: str, domain: str, challenge: str):
             output, vote = "ERROR", max_votes(votes)
             break
 
-    log(req_start=req_start, req_end=time(), ok="ERR" not in output, domain=domain, results=results)
+    log(req_start=req_start, req_end=time(), ok="ERR" not in output, protocol=protocol, domain=domain, challenge=challenge, results=results)
     return output
 
 
+def lease_circuit(tor: TorInstance, stream_id: str, exclude: Set[str]) -> Tuple[str, str]:
+    available_circs = [circ for circ in tor.ctrl.get_circuits() if circ.status == "BUILT" and len(circ.path) > 1 and circ.id not in exclude and tor.created.get(circ.id, 0) + CIRCUIT_TTL > time()]
+    circ = random.choice(available_circs)
+    tor.ctrl.attach_stream(stream_id, circ.id)
+    return circ.id, exit_ip_of(tor.ctrl, circ)
+
+
+def lease_batch(tor: TorInstance, new_streams: List[str], detached_streams: List[str], current_circuits: Set[str], stream_exits: dict) -> int:
+    # all leases and closes of one poll in a single broker round trip, the broker leases distinct circuits within a batch
+    ops = [{"op": "lease", "stream": stream_id, "exclude": list(current_circuits)} for stream_id in new_streams]
+    ops += [{"op": "close_stream", "stream": stream_id} for stream_id in detached_streams]
+    if not ops:
+        return 0
+
+    dropped, delay = 0, 0
+    for stream_id, result in zip(new_streams, tor.ctrl.batch(ops)):
+        # streams that could not be leased are still NEW and leased again with the next poll
+        try:
+            lease = unpack(result)
+            stream_exits[stream_id] = lease["exit"]
+            add_lease(tor, lease["circ"], current_circuits)
+        except (InvalidArguments, InvalidRequest):
+            dropped += 1
+        except IndexError:
+            delay = 0.5
+        except:
+            delay = max(delay, 0.1)
+    sleep(delay)
+    return dropped
+
+
+def add_lease(tor: TorInstance, circ_id: str, current_circuits: Set[str]):
+    current_circuits.add(circ_id)
+    if not tor.created.get(circ_id):
+        tor.created[circ_id] = time()
+
+
 def subnet_of(ip: str) -> IPv4Network:
     return IPv4Network(f"{ip}/{PREFIX_LEN}", strict=False)
 
 
-def subnets_in_use() -> Set[IPv4Network]:
-    return {subnet_of(exit_ip_of(circ)) for circ in ctrl.get_circuits()}
+def subnets_in_use(ctrl: Controller) -> Set[IPv4Network]:
+    return {subnet_of(exit_ip_of(ctrl, circ)) for circ in ctrl.get_circuits()}
 
 
-def exit_ip_of(circ: Union[CircuitEvent, str]) -> str:
+def exit_ip_of(ctrl: Controller, circ: Union[CircuitEvent, str]) -> str:
     try:
         if isinstance(circ, str):
             circ = ctrl.get_circuit(circ)
@@ -130,9 +187,10 @@ def max_votes(votes: dict) -> int:
         return 0
 
 
-def get(url: str) -> str:
+def get(sess: requests.Session, url: str) -> str:
     try:
-        r = sess.get(url, allow_redirects=False, timeout=REQUEST_TIMEOUT)
+        # never reuse a connection, every vote has to open its own stream through a fresh circuit
+        r = sess.get(url, allow_redirects=False, timeout=REQUEST_TIMEOUT, headers={"Connection": "close"})
         r.raise_for_status()
         return r.text
     except Exception as e:
@@ -140,7 +198,7 @@ def get(url: str) -> str:
 
 
 def log(**data):
-    with open(f"/app/logs/app-{PID}.log", "a") as f:
+    with open(f"{LOG_DIR}/app-{PID}.log", "a") as f:
         data = {k: list(v) if isinstance(v, set) else v for k, v in data.items()}
         f.write(json.dumps(data) + "\n")
 
@@ -153,20 +211,26 @@ def is_ip(s: str) -> bool:
     return re.match("[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}", s) is not None
 
 
-sess = requests.session()
-sess.proxies = {"http": "socks5h://127.0.0.1:9050",
-                "https": "socks5h://127.0.0.1:9050"}
+def connect(socks_port: int, control_port: int) -> TorInstance:
+    sess = requests.session()
+    sess.proxies = {"http": f"socks5h://127.0.0.1:{socks_port}",
+                    "https": f"socks5h://127.0.0.1:{socks_port}"}
+
+    while True:
+        try:
+            ctrl = instrument(BrokerController(socket_path(control_port)) if BROKER_SOCKET else Controller.from_port(port=control_port), process="tova", interval=METRICS_INTERVAL, log_dir=LOG_DIR)
+            break
+        except (SocketError, OSError):
+            sleep(2)
+    ctrl.authenticate()
+
+    return TorInstance(ctrl, sess, UltraDict(name=f"circuit_creation_{control_port}"))
 
-while True:
-    try:
-        ctrl = Controller.from_port()
-        break
-    except SocketError:
-        sleep(2)
-ctrl.authenticate()
 
-created = UltraDict(name="circuit_creation")
 PID = os.getpid()
+tor_instances = [connect(socks_port, control_port) for socks_port, control_port in TOR_INSTANCES]
+# each worker cycles through all instances, starting at a different one
+instances = islice(cycle(tor_instances), PID % len(tor_instances), None)
 
 
 if __name__ == '__main__':
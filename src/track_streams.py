@@ -1,13 +1,21 @@
 #!/usr/bin/env python3
 import functools
+import sys
 
 from stem.control import EventType, Controller
 
+from ctrl_metrics import instrument
+from env import TOR_INSTANCES, METRICS_INTERVAL, LOG_DIR
+
+# index of the tor instance in TOR_INSTANCES, like circus.py
+SOCKS_PORT, CONTROL_PORT = TOR_INSTANCES[int(sys.argv[1]) if len(sys.argv) > 1 else 0]
+
 def main():
-  print("Tracking requests for tor exits. Press 'enter' to end.")
+  print(f"Tracking requests for tor exits of control port {CONTROL_PORT}. Press 'enter' to end.")
   print("")
 
-  with Controller.from_port() as controller:
+  with Controller.from_port(port=CONTROL_PORT) as ctrl:
+    controller = instrument(ctrl, process=f"track_streams-{CONTROL_PORT}", interval=METRICS_INTERVAL, log_dir=LOG_DIR)
     controller.authenticate()
 
     stream_listener = functools.partial(stream_event, controller)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+import json
+from argparse import Namespace, ArgumentParser
+from itertools import product
+
+import numpy as np
+from scipy.special import gammaln
+
+EXITS = 2254
+# bound on the (trials x exits) random keys held at once
+MC_BATCH_KEYS = 2**24
+
+
+def log_binom(n, k) -> np.ndarray:
+    # log of n over k for arrays, -inf outside of 0 <= k <= n
+    n, k = np.asarray(n, dtype=np.float64), np.asarray(k, dtype=np.float64)
+    valid = (k >= 0) & (k <= n)
+    with np.errstate(invalid="ignore"):
+        return np.where(valid, gammaln(n + 1) - gammaln(k + 1) - gammaln(n - k + 1), -np.inf)
+
+
+def hypergeom_pmf(j, n, M, N) -> np.ndarray:
+    # probability of exactly j malicious among n exits drawn without replacement from N exits, M of them malicious
+    return np.exp(log_binom(M, j) + log_binom(N - M, n - j) - log_binom(N, n))
+
+
+def tail_probability(k, n, M, N) -> np.ndarray:
+    # probability of at least k malicious among n drawn exits, all arguments broadcast against each other
+    k, n, M, N = np.broadcast_arrays(*[np.asarray(a)[..., np.newaxis] for a in (k, n, M, N)])
+    j = np.arange(int(n.max()) + 1)
+    return np.where((j >= k) & (j <= n), hypergeom_pmf(j, n, M, N), 0).sum(axis=-1)
+
+
+def success_probability(k: int, n: int, M, N) -> np.ndarray:
+    # probability that M malicious of N exits win a validation under tova.py's rule: batches of VAL_K minus the leading
+    # vote count are drawn until one answer has VAL_K votes or VAL_N votes are in, all honest exits agree;
+    # exact over the (honest, malicious) vote states with hypergeometric batch transitions, M and N broadcast
+    M, N = np.broadcast_arrays(np.asarray(M, dtype=np.float64), np.asarray(N, dtype=np.float64))
+    success = np.zeros(M.shape)
+    states = {(0, 0): np.ones(M.shape)}
+    # every batch adds votes, so states are final once all states with fewer votes were expanded
+    for votes in range(n + k):
+        for (honest, malicious), p in sorted((state, p) for state, p in states.items() if sum(state) == votes):
+            del states[(honest, malicious)]
+            batch = k - max(honest, malicious)
+            for j in range(batch + 1):
+                p_next = p * hypergeom_pmf(j, batch, M - malicious, N - votes)
+                state = (honest + batch - j, malicious + j)
+                if state[1] >= k:
+                    success += p_next
+                elif state[0] < k and sum(state) < n:
+                    states[state] = states.get(state, 0) + p_next
+    return success
+
+
+def monte_carlo(k: int, n: int, weights: np.ndarray, malicious: np.ndarray, trials: int, rng: np.random.Generator) -> int:
+    # successful attacks among trials validations under tova.py's rule, exits are drawn without replacement with
+    # probability proportional to weights (exponential clocks: the order of exponential(1) / weight is a weighted draw order)
+    n_draws = min(len(weights), n + k - 1)
+    batch_size = max(1, MC_BATCH_KEYS // len(weights))
+    successes = 0
+    for start in range(0, trials, batch_size):
+        batch = min(batch_size, trials - start)
+        keys = rng.exponential(size=(batch, len(weights))) / weights
+        drawn = np.argpartition(keys, n_draws - 1, axis=1)[:, :n_draws]
+        drawn = np.take_along_axis(drawn, np.argsort(np.take_along_axis(keys, drawn, axis=1), axis=1), axis=1)
+        # malicious votes among the first i drawn exits
+        hits = np.zeros((batch, n_draws + 1), dtype=np.int64)
+        np.cumsum(malicious[drawn], axis=1, out=hits[:, 1:])
+
+        rows = np.arange(batch)
+        position = np.zeros(batch, dtype=np.int64)
+        while True:
+            leading = np.maximum(hits[rows, position], position - hits[rows, position])
+            active = (leading < k) & ((position < n) | (position == 0)) & (position < n_draws)
+            if not active.any():
+                break
+            position = np.where(active, np.minimum(position + k - leading, n_draws), position)
+        successes += int((hits[rows, position] >= k).sum())
+    return successes
+
+
+def read_exit_weights(filename: str) -> np.ndarray:
+    # selection weight of every usable exit (filtered like circus.py): the consensus weight scaled by the exit position weight
+    # (Wee, or Wed for guards) of tor's cached-consensus / cached-microdesc-consensus, a circus snapshot (.json) has no position weights
+    # stem is only needed for consensus files
+    from stem import Flag
+    from stem.descriptor import parse_file, DocumentHandler
+    from stem.descriptor.router_status_entry import RouterStatusEntryV3
+
+    if filename.endswith(".json"):
+        with open(filename) as f:
+            snapshot = json.load(f)
+        relays = [RouterStatusEntryV3(content, validate=False) for content in snapshot["exits"]]
+        position_weights = {}
+    else:
+        document_type = "network-status-microdesc-consensus-3 1.0" if "microdesc" in filename else "network-status-consensus-3 1.0"
+        document = next(parse_file(filename, document_type, document_handler=DocumentHandler.DOCUMENT))
+        relays = list(document.routers.values())
+        position_weights = document.bandwidth_weights
+
+    exits = [relay for relay in relays if Flag.EXIT in relay.flags and Flag.BADEXIT not in relay.flags and Flag.RUNNING in relay.flags]
+    return np.array([(relay.bandwidth or 0) * position_weights.get("Wed" if Flag.GUARD in relay.flags else "Wee", 10000) / 10000 for relay in exits])
+
+
+def max_tolerated(k: int, n: int, exits: int, target: float) -> int:
+    # most attacker exits (added to the honest ones, at most as many) that keep the closed-form success probability below target
+    M = np.arange(exits + 1)
+    below = success_probability(k, n, M, exits + M) < target
+    return int(M[below].max()) if below.any() else -1
+
+
+def sweep(args: Namespace, weights: np.ndarray):
+    rng = np.random.default_rng(args.seed)
+    attacker_weight = args.attacker_bandwidth if args.attacker_bandwidth else float(np.median(weights))
+    M = np.array(args.malicious)
+    for k, n in [(k, n) for k, n in product(args.val_k, args.val_n) if n >= k]:
+        print(f"VAL_K={k} VAL_N={n}: up to {max_tolerated(k, n, len(weights), args.target)} attacker exits keep the attack success below {100 * args.target}%")
+        closed_form = success_probability(k, n, M, len(weights) + M)
+        for m, p in zip(M, closed_form):
+            line = f"  {m} attacker exits: {100 * p:.4f}% closed form"
+            if args.trials:
+                p_mc = monte_carlo(k, n, np.concatenate([weights, np.full(m, attacker_weight)]), np.arange(len(weights) + m) >= len(weights), args.trials, rng) / args.trials
+                line += f", {100 * p_mc:.4f}% ± {196 * np.sqrt(p_mc * (1 - p_mc) / args.trials):.4f}% monte carlo"
+            print(line)
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(description="Probability that an attacker running malicious exits wins a TOVA validation, closed form for uniformly chosen exits "
+                                        "(as circus.py picks them) cross-checked by a Monte Carlo simulation that can also use consensus exit weights")
+    parser.add_argument("--val-k", nargs="+", type=int, default=[3, 5, 7], help="VAL_K values to sweep (default: %(default)s)")
+    parser.add_argument("--val-n", nargs="+", type=int, default=[4, 7, 9], help="VAL_N values to sweep, combined with every VAL_K <= VAL_N (default: %(default)s)")
+    parser.add_argument("--malicious", "-m", nargs="+", type=int, default=[10, 50, 100, 250, 500], help="attacker exits added to the honest ones (default: %(default)s)")
+    parser.add_argument("--exits", type=int, default=EXITS, help="honest exits without --consensus (default: %(default)s)")
+    parser.add_argument("--consensus", metavar="FILE", help="tor cached-consensus / cached-microdesc-consensus or a circus snapshot (.json) to take the exits from")
+    parser.add_argument("--weights", choices=["uniform", "bandwidth"], default="uniform",
+                        help="Monte Carlo exit selection: uniform like circus.py or by consensus bandwidth weights like tor (with --consensus, default: %(default)s)")
+    parser.add_argument("--attacker-bandwidth", type=float, help="weight of every attacker exit with --weights bandwidth (default: median exit weight)")
+    parser.add_argument("--trials", type=int, default=100000, help="Monte Carlo validations per scenario, 0 for the closed form only (default: %(default)s)")
+    parser.add_argument("--target", type=float, default=0.01, help="tolerated attack success probability (default: %(default)s)")
+    parser.add_argument("--seed", type=int, help="Monte Carlo random seed")
+    args = parser.parse_args()
+    if args.weights == "bandwidth" and not args.consensus:
+        parser.error("--weights bandwidth requires --consensus")
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if not args.consensus:
+        weights = np.ones(args.exits)
+    elif args.weights == "bandwidth":
+        weights = read_exit_weights(args.consensus)
+        # tor never selects exits without weight
+        weights = weights[weights > 0]
+    else:
+        weights = np.ones(len(read_exit_weights(args.consensus)))
+    sweep(args, weights)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+from argparse import Namespace, ArgumentParser
+from multiprocessing import Pool
+from os.path import dirname, abspath, join
+from time import time, sleep
+from typing import List, Tuple
+
+from stem import SocketError
+from stem.control import Controller
+from tqdm import tqdm
+
+SRC_DIR = join(dirname(dirname(dirname(abspath(__file__)))), "src")
+FAKE_TOR = join(dirname(abspath(__file__)), "fake_tor.py")
+
+tova = None
+
+
+def main(args: Namespace):
+    tmp_dir = tempfile.mkdtemp(prefix="tova-bench-")
+    env = {**os.environ,
+           "CIRCUIT_TTL": str(args.circuit_ttl),
+           "REQUEST_TIMEOUT": str(args.request_timeout),
+           "VAL_K": str(args.val_k),
+           "VAL_N": str(args.val_n),
+           "N_CIRCUITS": str(args.circuits),
+           "PREFIX_LEN": str(args.prefix_len),
+           "BUILD_INTERVAL": "1",
+           "STATE_DIR": tmp_dir,
+           "SNAPSHOT_INTERVAL": "60",
+           "SNAPSHOT_MAX_AGE": "0",
+           "BROKER_SOCKET": join(tmp_dir, "broker.sock") if args.broker else "",
+           "TOR_INSTANCES": f"{args.socks_port}:{args.control_port}",
+           "METRICS_INTERVAL": "0",
+           "LOG_DIR": tmp_dir}
+
+    processes = [subprocess.Popen([sys.executable, FAKE_TOR, "--socks-port", str(args.socks_port), "--control-port", str(args.control_port),
+                                   "--relays", str(args.relays), "--latency", str(args.latency), "--failure-rate", str(args.failure_rate),
+                                   "--build-latency", str(args.build_latency), "--body", args.body, "--bad-exits", str(args.bad_exits)] +
+                                  (["--seed", str(args.seed)] if args.seed is not None else []))]
+    try:
+        ctrl = connect(args.control_port)
+        if processes[0].poll() is not None:
+            raise SystemExit(f"fake tor failed to start, are ports {args.socks_port}/{args.control_port} in use?")
+        processes.append(subprocess.Popen([sys.executable, "circus.py"], cwd=SRC_DIR, env=env))
+        if args.broker:
+            processes.append(subprocess.Popen([sys.executable, "broker.py"], cwd=SRC_DIR, env=env))
+        fill_time = wait_for_pool(ctrl, args.circuits)
+        print(f"pool filled in {round(fill_time, ndigits=1)}s", file=sys.stderr)
+        if args.serve:
+            serve(args, env)
+            return
+
+        # one process per concurrent validation, like gunicorn's sync workers
+        os.environ.update(env)
+        with Pool(args.concurrency, initializer=init_worker) as pool:
+            pool.map(ready, range(args.concurrency))
+            start = time()
+            results = list(tqdm(pool.imap_unordered(validate, ((i, args.body) for i in range(args.requests))), total=args.requests, desc="validations", leave=False))
+            duration = time() - start
+        report(args, results, duration, fill_time)
+
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+def connect(port: int) -> Controller:
+    for _ in range(50):
+        try:
+            ctrl = Controller.from_port(port=port)
+            ctrl.authenticate()
+            return ctrl
+        except SocketError:
+            sleep(0.2)
+    raise SocketError(f"fake tor not reachable on port {port}")
+
+
+def serve(args: Namespace, env: dict):
+    # tova's HTTP API on the fake network, one gunicorn sync worker per concurrent validation like in the container
+    gunicorn = subprocess.Popen([sys.executable, "-m", "gunicorn", "--bind", f"127.0.0.1:{args.serve}", "--workers", str(args.concurrency),
+                                 "--timeout", str(2 * args.request_timeout), "tova:app"], cwd=SRC_DIR, env=env)
+    print(f"serving tova on http://127.0.0.1:{args.serve}, stop with Ctrl-C", file=sys.stderr)
+    # SIGTERM stops gunicorn too, so the fake tor and circus are cleaned up as well
+    signal.signal(signal.SIGTERM, lambda *_: gunicorn.terminate())
+    try:
+        gunicorn.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        gunicorn.terminate()
+        gunicorn.wait()
+
+
+def wait_for_pool(ctrl: Controller, n_circuits: int, timeout: int = 300) -> float:
+    start = time()
+    while time() < start + timeout:
+        if sum(1 for circ in ctrl.get_circuits() if circ.status == "BUILT") >= 0.9 * n_circuits:
+            break
+        sleep(0.5)
+    return time() - start
+
+
+def init_worker():
+    global tova
+    sys.path.insert(0, SRC_DIR)
+    import tova
+
+
+def ready(_) -> bool:
+    return tova is not None
+
+
+def validate(args: Tuple[int, str]) -> Tuple[float, bool]:
+    i, expected = args
+    start = time()
+    output = tova.acme_proxy("http", f"d{i}.bench.test", "challenge")
+    return time() - start, output == expected
+
+
+def percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def report(args: Namespace, results: List[Tuple[float, bool]], duration: float, fill_time: float):
+    latencies = [latency for latency, _ in results]
+    summary = {"time": time(),
+               "requests": len(results),
+               "concurrency": args.concurrency,
+               "broker": args.broker,
+               "ok": sum(1 for _, ok in results if ok),
+               "duration": round(duration, ndigits=3),
+               "validations_per_s": round(len(results) / duration, ndigits=2),
+               "pool_fill_s": round(fill_time, ndigits=2),
+               **{f"p{p}": round(percentile(latencies, p), ndigits=3) for p in [50, 90, 99]},
+               "max": round(max(latencies), ndigits=3)}
+
+    print(f"validations:   {summary['requests']} ({summary['ok']} ok)")
+    print(f"throughput:    {summary['validations_per_s']}/s")
+    print(f"latency:       p50 {summary['p50']}s, p90 {summary['p90']}s, p99 {summary['p99']}s, max {summary['max']}s")
+
+    if args.json:
+        with open(args.json, "a") as f:
+            f.write(json.dumps(summary) + "\n")
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(description="Offline throughput benchmark of tova's acme_proxy against fake_tor.py (no network access needed)")
+    parser.add_argument("--requests", "-r", type=int, default=200, help="number of validations (default: %(default)s)")
+    parser.add_argument("--concurrency", "-c", type=int, default=10, help="concurrent validations (default: %(default)s)")
+    parser.add_argument("--broker", action="store_true", help="route control port calls through broker.py")
+    parser.add_argument("--json", metavar="FILE", help="append result summary as JSON line to FILE")
+    parser.add_argument("--serve", metavar="PORT", type=int, help="serve tova's HTTP API on 127.0.0.1:PORT with --concurrency gunicorn workers "
+                                                                  "until interrupted instead of driving acme_proxy, e.g. for replay.py or client.py")
+    parser.add_argument("--socks-port", type=int, default=19050, help="fake tor SOCKS port (default: %(default)s)")
+    parser.add_argument("--control-port", type=int, default=19051, help="fake tor control port (default: %(default)s)")
+    parser.add_argument("--relays", type=int, default=2000, help="relays in the fake consensus (default: %(default)s)")
+    parser.add_argument("--latency", type=float, default=0.2, help="mean per-exit latency in seconds (default: %(default)s)")
+    parser.add_argument("--failure-rate", type=float, default=0.05, help="stream failure probability (default: %(default)s)")
+    parser.add_argument("--build-latency", type=float, default=0.5, help="mean circuit build time in seconds (default: %(default)s)")
+    parser.add_argument("--body", default="challenge-token", help="expected challenge response (default: %(default)s)")
+    parser.add_argument("--bad-exits", type=float, default=0.0, help="fraction of exits returning a wrong body (default: %(default)s)")
+    parser.add_argument("--seed", type=int, help="random seed for the fake consensus")
+    parser.add_argument("--circuits", type=int, default=50, help="N_CIRCUITS (default: %(default)s)")
+    parser.add_argument("--circuit-ttl", type=int, default=180, help="CIRCUIT_TTL (default: %(default)s)")
+    parser.add_argument("--request-timeout", type=int, default=30, help="REQUEST_TIMEOUT (default: %(default)s)")
+    parser.add_argument("--val-k", type=int, default=5, help="VAL_K (default: %(default)s)")
+    parser.add_argument("--val-n", type=int, default=7, help="VAL_N (default: %(default)s)")
+    parser.add_argument("--prefix-len", type=int, default=9, help="PREFIX_LEN (default: %(default)s)")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_args())
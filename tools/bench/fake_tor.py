@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+import base64
+import hashlib
+import random
+import socket
+import struct
+from argparse import Namespace, ArgumentParser
+from datetime import datetime
+from itertools import count
+from socketserver import ThreadingTCPServer, StreamRequestHandler
+from threading import Thread, Lock, RLock, Event, Timer
+from time import sleep
+from typing import List, Optional
+
+VERSION = "0.4.8.10"
+STREAM_TIMEOUT = 120
+
+
+class Relay:
+    def __init__(self, i: int, address: str, flags: List[str], bandwidth: int, latency: float):
+        self.nickname = f"fake{i}"
+        self.identity = hashlib.sha1(f"fake-relay-{i}".encode()).digest()
+        self.fingerprint = self.identity.hex().upper()
+        self.address = address
+        self.flags = flags
+        self.bandwidth = bandwidth
+        self.latency = latency
+
+    def ns_entry(self) -> str:
+        identity = base64.b64encode(self.identity).decode().rstrip("=")
+        digest = base64.b64encode(hashlib.sha1(self.identity).digest()).decode().rstrip("=")
+        return f"r {self.nickname} {identity} {digest} {datetime.utcnow():%Y-%m-%d %H:%M:%S} {self.address} 9001 0\r\n" \
+               f"s {' '.join(sorted(self.flags))}\r\n" \
+               f"w Bandwidth={self.bandwidth}\r\n"
+
+
+class FakeTor:
+    def __init__(self, args: Namespace):
+        self.args = args
+        self.lock = RLock()
+        self.ids = count(1)
+        self.relays = generate_relays(args.relays, args.exit_ratio, args.latency)
+        self.by_fingerprint = {relay.fingerprint: relay for relay in self.relays}
+        self.bad_exits = {relay.fingerprint for relay in self.relays if "Exit" in relay.flags and random.random() < args.bad_exits}
+        self.circuits = {}
+        self.streams = {}
+        self.controls = set()
+
+    def emit(self, event_type: str, line: str):
+        for control in list(self.controls):
+            if event_type in control.events:
+                control.send(f"650 {event_type} {line}")
+
+    def circuit_line(self, circ: dict) -> str:
+        path = ",".join(f"${fp}~{self.by_fingerprint[fp].nickname}" for fp in circ["built_path"])
+        return " ".join(field for field in [circ["id"], circ["status"], path, f"PURPOSE={circ['purpose']}"] if field)
+
+    def stream_line(self, stream: dict) -> str:
+        return f"{stream['id']} {stream['status']} {stream['circ_id']} {stream['target']}:{stream['port']}"
+
+    def set_circuit_status(self, circ: dict, status: str):
+        with self.lock:
+            circ["status"] = status
+            if status == "BUILT":
+                circ["built_path"] = circ["path"]
+            if status in ("FAILED", "CLOSED"):
+                self.circuits.pop(circ["id"], None)
+            self.emit("CIRC", self.circuit_line(circ))
+
+    def set_stream_status(self, stream: dict, status: str):
+        with self.lock:
+            stream["status"] = status
+            if status == "CLOSED":
+                self.streams.pop(stream["id"], None)
+            self.emit("STREAM", self.stream_line(stream))
+
+    def extend_circuit(self, path: List[str], purpose: str) -> str:
+        if any(fp not in self.by_fingerprint for fp in path):
+            raise KeyError(path)
+        with self.lock:
+            circ = {"id": str(next(self.ids)), "status": "LAUNCHED", "path": path, "built_path": [], "purpose": purpose.upper()}
+            self.circuits[circ["id"]] = circ
+            self.emit("CIRC", self.circuit_line(circ))
+
+        status = "FAILED" if random.random() < self.args.build_failure_rate else "BUILT"
+        Timer(random.expovariate(1 / self.args.build_latency), self.set_circuit_status, args=(circ, status)).start()
+        return circ["id"]
+
+    def new_stream(self, target: str, port: int) -> dict:
+        with self.lock:
+            stream = {"id": str(next(self.ids)), "status": "NEW", "circ_id": "0", "target": target, "port": port, "attached": Event()}
+            self.streams[stream["id"]] = stream
+            self.emit("STREAM", self.stream_line(stream))
+        return stream
+
+    def exit_of(self, stream: dict) -> Optional[Relay]:
+        circ = self.circuits.get(stream["circ_id"])
+        return self.by_fingerprint[circ["path"][-1]] if circ else None
+
+    def command(self, control: "ControlHandler", line: str) -> str:
+        keyword, _, args = line.partition(" ")
+        keyword = keyword.upper()
+
+        if keyword == "PROTOCOLINFO":
+            return f'250-PROTOCOLINFO 1\r\n250-AUTH METHODS=NULL\r\n250-VERSION Tor="{VERSION}"\r\n250 OK'
+        elif keyword in ("AUTHENTICATE", "TAKEOWNERSHIP", "RESETCONF", "SETCONF", "SIGNAL"):
+            return "250 OK"
+        elif keyword == "GETCONF":
+            return "\r\n".join(f"250{'-' if i < len(args.split()) - 1 else ' '}{key}" for i, key in enumerate(args.split()))
+        elif keyword == "SETEVENTS":
+            control.events = set(args.split())
+            return "250 OK"
+        elif keyword == "GETINFO":
+            return self.getinfo(args.split())
+        elif keyword == "EXTENDCIRCUIT":
+            circ_id, path, *options = args.split()
+            if circ_id != "0":
+                return f"552 Unknown circuit \"{circ_id}\""
+            purpose = dict(option.split("=", 1) for option in options).get("purpose", "general")
+            try:
+                return f"250 EXTENDED {self.extend_circuit(path.split(','), purpose)}"
+            except KeyError:
+                return f"552 No such router \"{path}\""
+        elif keyword == "CLOSECIRCUIT":
+            circ = self.circuits.get(args.split()[0])
+            if not circ:
+                return f"552 Unknown circuit \"{args.split()[0]}\""
+            self.set_circuit_status(circ, "CLOSED")
+            return "250 OK"
+        elif keyword == "ATTACHSTREAM":
+            stream_id, circ_id = args.split()[:2]
+            with self.lock:
+                stream, circ = self.streams.get(stream_id), self.circuits.get(circ_id)
+                if not stream:
+                    return f"552 Unknown stream \"{stream_id}\""
+                if not circ:
+                    return f"552 Unknown circuit \"{circ_id}\""
+                if circ["status"] != "BUILT" or stream["circ_id"] != "0":
+                    return "555 Connection is not managed by controller."
+                stream["circ_id"] = circ_id
+                self.set_stream_status(stream, "SENTCONNECT")
+                stream["attached"].set()
+            return "250 OK"
+        elif keyword == "CLOSESTREAM":
+            stream = self.streams.get(args.split()[0])
+            if not stream:
+                return f"552 Unknown stream \"{args.split()[0]}\""
+            self.set_stream_status(stream, "CLOSED")
+            stream["attached"].set()
+            return "250 OK"
+        elif keyword == "QUIT":
+            return "250 closing connection"
+        return f'510 Unrecognized command "{keyword}"'
+
+    def getinfo(self, keys: List[str]) -> str:
+        lines = []
+        for key in keys:
+            if key == "version":
+                value = f"{VERSION} (git-0000000000000000)"
+            elif key == "circuit-status":
+                with self.lock:
+                    value = "\r\n".join(self.circuit_line(circ) for circ in self.circuits.values())
+            elif key == "stream-status":
+                with self.lock:
+                    value = "\r\n".join(self.stream_line(stream) for stream in self.streams.values())
+            elif key == "ns/all":
+                value = "".join(relay.ns_entry() for relay in self.relays).rstrip("\r\n")
+            elif key.startswith("ns/id/") and key[6:].lstrip("$").upper() in self.by_fingerprint:
+                value = self.by_fingerprint[key[6:].lstrip("$").upper()].ns_entry().rstrip("\r\n")
+            else:
+                return f'552 Unrecognized key "{key}"'
+            lines.append(f"250+{key}=\r\n{value}\r\n." if "\r\n" in value else f"250-{key}={value}")
+        return "\r\n".join(lines + ["250 OK"])
+
+
+class ControlHandler(StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.events = set()
+        self.write_lock = Lock()
+        tor.controls.add(self)
+
+    def finish(self):
+        tor.controls.discard(self)
+        super().finish()
+
+    def send(self, reply: str):
+        with self.write_lock:
+            try:
+                self.wfile.write((reply + "\r\n").encode())
+                self.wfile.flush()
+            except OSError:
+                tor.controls.discard(self)
+
+    def handle(self):
+        for line in self.rfile:
+            line = line.decode().strip()
+            if line:
+                self.send(tor.command(self, line))
+            if line.upper() == "QUIT":
+                break
+
+
+class SocksHandler(StreamRequestHandler):
+    def handle(self):
+        _, n_methods = self.rfile.read(2)
+        self.rfile.read(n_methods)
+        self.wfile.write(b"\x05\x00")
+
+        _, cmd, _, atyp = self.rfile.read(4)
+        if atyp == 3:
+            target = self.rfile.read(self.rfile.read(1)[0]).decode()
+        elif atyp == 4:
+            target = socket.inet_ntop(socket.AF_INET6, self.rfile.read(16))
+        else:
+            target = socket.inet_ntoa(self.rfile.read(4))
+        port = struct.unpack("!H", self.rfile.read(2))[0]
+
+        stream = tor.new_stream(target, port)
+        exit = tor.exit_of(stream) if stream["attached"].wait(STREAM_TIMEOUT) else None
+        if not exit:
+            tor.set_stream_status(stream, "CLOSED")
+            self.wfile.write(b"\x05\x06\x00\x01\x00\x00\x00\x00\x00\x00")
+            return
+
+        sleep(random.expovariate(1 / exit.latency))
+        if random.random() < tor.args.failure_rate:
+            tor.set_stream_status(stream, "FAILED")
+            tor.set_stream_status(stream, "CLOSED")
+            self.wfile.write(b"\x05\x04\x00\x01\x00\x00\x00\x00\x00\x00")
+            return
+
+        stream["target"] = target_ip(target)
+        tor.set_stream_status(stream, "SUCCEEDED")
+        self.wfile.write(b"\x05\x00\x00\x01\x00\x00\x00\x00\x00\x00")
+
+        headers = []
+        while headers[-1:] != [b""]:
+            headers.append(self.rfile.readline().strip().lower())
+        close = b"connection: close" in headers
+
+        sleep(random.expovariate(1 / exit.latency))
+        body = (tor.args.bad_body if exit.fingerprint in tor.bad_exits else tor.args.body).encode()
+        self.wfile.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n" + (b"Connection: close\r\n" if close else b"") +
+                         b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+        self.wfile.flush()
+
+        # keep the stream open like a keep-alive web server would, until the client hangs up or the idle timeout hits
+        if not close:
+            self.connection.settimeout(tor.args.keepalive)
+            try:
+                while self.rfile.read(1):
+                    pass
+            except OSError:
+                pass
+        tor.set_stream_status(stream, "CLOSED")
+
+
+def target_ip(domain: str) -> str:
+    digest = hashlib.sha1(domain.encode()).digest()
+    return f"198.{18 + digest[0] % 2}.{digest[1]}.{digest[2]}"
+
+
+def generate_relays(n: int, exit_ratio: float, latency: float) -> List[Relay]:
+    relays = []
+    for i in range(n):
+        address = socket.inet_ntoa(struct.pack("!I", random.randint(0x01000000, 0xDFFFFFFF)))
+        flags = ["Fast", "Running", "Stable", "Valid"] + (["Exit"] if random.random() < exit_ratio else ["Guard"])
+        relays.append(Relay(i, address, flags, bandwidth=int(random.paretovariate(1.2) * 1000), latency=random.lognormvariate(0, 0.5) * latency))
+    return relays
+
+
+def serve(port: int, handler) -> ThreadingTCPServer:
+    ThreadingTCPServer.allow_reuse_address = True
+    server = ThreadingTCPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(description="Stand-in for a tor process: control port (enough for stem's circuit, stream, attach and event calls) and SOCKS5 proxy answering HTTP requests")
+    parser.add_argument("--socks-port", type=int, default=19050, help="SOCKS5 port (default: %(default)s)")
+    parser.add_argument("--control-port", type=int, default=19051, help="control port (default: %(default)s)")
+    parser.add_argument("--relays", type=int, default=2000, help="number of relays in the fake consensus (default: %(default)s)")
+    parser.add_argument("--exit-ratio", type=float, default=0.4, help="fraction of relays with the Exit flag (default: %(default)s)")
+    parser.add_argument("--latency", type=float, default=0.2, help="mean per-exit latency of connect and response in seconds (default: %(default)s)")
+    parser.add_argument("--failure-rate", type=float, default=0.05, help="probability of a stream failing at the exit (default: %(default)s)")
+    parser.add_argument("--build-latency", type=float, default=0.5, help="mean circuit build time in seconds (default: %(default)s)")
+    parser.add_argument("--build-failure-rate", type=float, default=0.1, help="probability of a circuit build failing (default: %(default)s)")
+    parser.add_argument("--body", default="challenge-token", help="response body of honest exits (default: %(default)s)")
+    parser.add_argument("--bad-exits", type=float, default=0.0, help="fraction of exits answering with --bad-body (default: %(default)s)")
+    parser.add_argument("--bad-body", default="tampered", help="response body of bad exits (default: %(default)s)")
+    parser.add_argument("--keepalive", type=float, default=5, help="idle seconds before the exit closes a finished stream (default: %(default)s)")
+    parser.add_argument("--seed", type=int, help="random seed for the generated consensus")
+    return parser.parse_args()
+
+
+tor = None
+
+if __name__ == '__main__':
+    args = parse_args()
+    random.seed(args.seed)
+    tor = FakeTor(args)
+    serve(args.control_port, ControlHandler)
+    serve(args.socks_port, SocksHandler)
+    print(f"fake tor: control port {args.control_port}, socks port {args.socks_port}, {len(tor.relays)} relays", flush=True)
+    try:
+        while True:
+            sleep(60)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+import heapq
+import json
+import os
+import random
+import sys
+import tempfile
+from argparse import Namespace, ArgumentParser
+from collections import namedtuple
+from ipaddress import IPv4Network
+from itertools import count
+from threading import RLock
+from os.path import dirname, abspath, join
+from time import time as wall_time
+from typing import List, Callable, Set, Optional
+
+from stem import InvalidArguments, InvalidRequest, DescriptorUnavailable, CircStatus, Flag
+from stem.control import Controller
+from stem.descriptor import parse_file, DocumentHandler
+from stem.descriptor.router_status_entry import RouterStatusEntry, RouterStatusEntryV3
+
+from fake_tor import generate_relays
+
+SRC_DIR = join(dirname(dirname(dirname(abspath(__file__)))), "src")
+
+Circuit = namedtuple("Circuit", ["id", "status", "path", "purpose"])
+
+
+class SimulationEnd(Exception):
+    pass
+
+
+class SharedDict(dict):
+    # stands in for circus' UltraDicts, including the lock of the one shared between tor instances
+    def __init__(self):
+        super().__init__()
+        self.lock = RLock()
+
+
+class Clock:
+    def __init__(self, duration: float):
+        self.now = self.start = wall_time()
+        self.end = self.start + duration
+        self.queue = []
+        self.seq = count()
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        until = self.now + seconds
+        while self.queue and self.queue[0][0] <= min(until, self.end):
+            self.now, _, callback, args = heapq.heappop(self.queue)
+            callback(*args)
+        self.now = until
+        if self.now >= self.end:
+            self.now = self.end
+            raise SimulationEnd()
+
+    def schedule(self, delay: float, callback: Callable, *args):
+        heapq.heappush(self.queue, (self.now + delay, next(self.seq), callback, args))
+
+
+class SimController:
+    def __init__(self, clock: Clock, relays: List[RouterStatusEntry], args: Namespace):
+        self.clock = clock
+        self.args = args
+        self.relays = relays
+        self.by_fingerprint = {relay.fingerprint: relay for relay in relays}
+        self.ids = count(1)
+        self.circuits = {}
+        self.listeners = []
+        self.stats = {"launched": 0, "built": 0, "failed": 0, "collapsed": 0, "closed": 0}
+        self.n_built = 0
+        self.pool = [(clock.now, 0)]
+
+    def authenticate(self):
+        pass
+
+    def add_event_listener(self, listener: Callable, *events):
+        self.listeners.append(listener)
+
+    def get_network_statuses(self) -> List[RouterStatusEntry]:
+        return list(self.relays)
+
+    def get_network_status(self, fingerprint: str) -> RouterStatusEntry:
+        try:
+            return self.by_fingerprint[fingerprint]
+        except KeyError:
+            raise DescriptorUnavailable(f"Tor was unable to provide the descriptor for '{fingerprint}'")
+
+    def get_circuits(self) -> List[Circuit]:
+        return list(self.circuits.values())
+
+    def get_circuit(self, circ_id: str) -> Circuit:
+        try:
+            return self.circuits[circ_id]
+        except KeyError:
+            raise ValueError(f"Tor currently does not have a circuit with the id of '{circ_id}'")
+
+    def get_streams(self) -> list:
+        return []
+
+    def new_circuit(self, path: List[str], await_build: bool = False) -> str:
+        if any(fingerprint not in self.by_fingerprint for fingerprint in path):
+            raise InvalidRequest("552", f"No such router \"{path}\"")
+        circ = Circuit(str(next(self.ids)), CircStatus.LAUNCHED, [], "GENERAL")
+        self.circuits[circ.id] = circ
+        self.stats["launched"] += 1
+
+        latency = random.lognormvariate(0, self.args.build_sigma) * self.args.build_median
+        if random.random() < self.args.build_failure_rate:
+            self.clock.schedule(latency, self.set_status, circ.id, CircStatus.FAILED)
+        else:
+            self.clock.schedule(latency, self.set_status, circ.id, CircStatus.BUILT, [(fp, self.by_fingerprint[fp].nickname) for fp in path])
+        return circ.id
+
+    def close_circuit(self, circ_id: str):
+        if circ_id not in self.circuits:
+            raise InvalidArguments("552", f"Unknown circuit \"{circ_id}\"")
+        self.stats["closed"] += 1
+        self.set_status(circ_id, CircStatus.CLOSED)
+
+    def set_status(self, circ_id: str, status: str, path: list = None):
+        if circ_id not in self.circuits:
+            return
+        if self.circuits[circ_id].status == CircStatus.BUILT:
+            self.n_built -= 1
+        circ = self.circuits[circ_id]._replace(status=status, path=path or self.circuits[circ_id].path)
+        if status in (CircStatus.FAILED, CircStatus.CLOSED):
+            del self.circuits[circ_id]
+        else:
+            self.circuits[circ_id] = circ
+
+        if status == CircStatus.BUILT:
+            self.stats["built"] += 1
+            self.n_built += 1
+            if self.args.collapse_rate > 0:
+                self.clock.schedule(random.expovariate(self.args.collapse_rate / 3600), self.collapse, circ_id)
+        elif status == CircStatus.FAILED:
+            self.stats["failed"] += 1
+        self.pool.append((self.clock.now, self.n_built))
+
+        for listener in self.listeners:
+            listener(circ)
+
+    def collapse(self, circ_id: str):
+        if circ_id in self.circuits and self.circuits[circ_id].status == CircStatus.BUILT:
+            self.stats["collapsed"] += 1
+            self.set_status(circ_id, CircStatus.CLOSED)
+
+
+def main(args: Namespace):
+    random.seed(args.seed)
+    relays = load_relays(args)
+    available = len(exit_subnets(relays, args.prefix_len))
+    if args.circuits > available:
+        # circus keeps at most one circuit per exit subnet, a larger pool never fills and every renewal scans all exits
+        print(f"only {available} /{args.prefix_len} exit subnets in the consensus, simulating {available} instead of {args.circuits} circuits")
+        args.circuits = available
+    tmp_dir = tempfile.mkdtemp(prefix="tova-sim-")
+    os.environ.update({"CIRCUIT_TTL": str(args.circuit_ttl),
+                       "REQUEST_TIMEOUT": "30",
+                       "VAL_K": str(args.val_k),
+                       "VAL_N": str(args.val_k),
+                       "N_CIRCUITS": str(args.circuits),
+                       "PREFIX_LEN": str(args.prefix_len),
+                       "BUILD_INTERVAL": str(args.build_interval),
+                       "STATE_DIR": tmp_dir,
+                       "SNAPSHOT_INTERVAL": "600",
+                       "SNAPSHOT_MAX_AGE": "0",
+                       "BROKER_SOCKET": "",
+                       "TOR_INSTANCES": "29150:29151",
+                       "METRICS_INTERVAL": "0",
+                       "LOG_DIR": tmp_dir})
+
+    clock = Clock(args.duration)
+    sim = SimController(clock, relays, args)
+    Controller.from_port = lambda port=9051: sim
+    sys.path.insert(0, SRC_DIR)
+    sys.argv = sys.argv[:1]
+    import circus
+    from ctrl_metrics import metrics
+
+    # circus logic runs unchanged, only the clock, the network and the process-shared dicts are replaced
+    circus.time = clock.time
+    circus.sleep = clock.sleep
+    circus.get_ip = lambda: args.host_ip
+    circus.created = SharedDict()
+    circus.subnets = SharedDict()
+
+    start = wall_time()
+    try:
+        circus.main()
+    except SimulationEnd:
+        pass
+    report(args, sim, clock, metrics.snapshot()["methods"], wall_time() - start, len(relays))
+
+
+def load_relays(args: Namespace) -> List[RouterStatusEntry]:
+    if not args.consensus:
+        return [RouterStatusEntryV3(relay.ns_entry().replace("\r\n", "\n"), validate=False) for relay in generate_relays(args.relays, args.exit_ratio, latency=0)]
+
+    if args.consensus.endswith(".json"):
+        # circus pool snapshot (STATE_DIR/circus-<control port>.json)
+        with open(args.consensus) as f:
+            snapshot = json.load(f)
+        return [RouterStatusEntryV3(content, validate=False) for content in snapshot["guards"] + snapshot["exits"]]
+
+    # tor's cached-consensus or cached-microdesc-consensus from its data directory
+    document_type = "network-status-microdesc-consensus-3 1.0" if "microdesc" in args.consensus else "network-status-consensus-3 1.0"
+    return list(parse_file(args.consensus, document_type, document_handler=DocumentHandler.ENTRIES))
+
+
+def exit_subnets(relays: List[RouterStatusEntry], prefix_len: int) -> Set[IPv4Network]:
+    # the exits circus builds circuits to
+    return {IPv4Network(f"{relay.address}/{prefix_len}", strict=False) for relay in relays
+            if Flag.EXIT in relay.flags and Flag.BADEXIT not in relay.flags and Flag.RUNNING in relay.flags}
+
+
+def pool_stats(pool: List[tuple], start: float, end: float, target: int) -> dict:
+    fill = {}
+    for p in [50, 90, 100]:
+        fill[f"fill_{p}_s"] = next((round(t - start, ndigits=1) for t, size in pool if size >= p / 100 * target), None)
+
+    # time weighted pool size after the pool first reached 90%
+    steady_start = start + (fill["fill_90_s"] if fill["fill_90_s"] is not None else end - start)
+    steady = [(max(t, steady_start), size) for t, size in pool if t >= steady_start] or [(steady_start, pool[-1][1])]
+    steady = [(steady_start, steady[0][1])] + steady + [(end, steady[-1][1])]
+    weighted = sum((t2 - t1) * size for (t1, size), (t2, _) in zip(steady, steady[1:]))
+    return {**fill,
+            "pool_min": min(size for _, size in steady) if fill["fill_90_s"] is not None else None,
+            "pool_mean": round(weighted / (end - steady_start), ndigits=1) if end > steady_start else None}
+
+
+def subnet_stats(sim: SimController, prefix_len: int) -> dict:
+    exits = [sim.get_network_status(circ.path[-1][0]).address for circ in sim.get_circuits() if circ.status == CircStatus.BUILT]
+    subnets = [IPv4Network(f"{ip}/{prefix_len}", strict=False) for ip in exits]
+    return {"pool_end": len(exits),
+            "exit_subnets": len(set(subnets)),
+            "exit_slash16": len({IPv4Network(f"{ip}/16", strict=False) for ip in exits}),
+            "duplicate_subnets": len(subnets) - len(set(subnets))}
+
+
+def report(args: Namespace, sim: SimController, clock: Clock, methods: dict, real_duration: float, n_relays: int):
+    duration = clock.now - clock.start
+    calls = sum(stats["calls"] for stats in methods.values())
+    summary = {"time": wall_time(),
+               "relays": n_relays,
+               "circuits": args.circuits,
+               "circuit_ttl": args.circuit_ttl,
+               "build_interval": args.build_interval,
+               "simulated_s": round(duration, ndigits=1),
+               "real_s": round(real_duration, ndigits=2),
+               **pool_stats(sim.pool, clock.start, clock.now, args.circuits),
+               **subnet_stats(sim, args.prefix_len),
+               **sim.stats,
+               "ctrl_calls_per_s": round(calls / duration, ndigits=2),
+               "ctrl_calls": {method: stats["calls"] for method, stats in sorted(methods.items())}}
+
+    print(f"simulated:     {summary['simulated_s']}s in {summary['real_s']}s ({round(duration / real_duration)}x real time), {n_relays} relays")
+    print(f"pool fill:     50% {fmt(summary['fill_50_s'], 's')}, 90% {fmt(summary['fill_90_s'], 's')}, 100% {fmt(summary['fill_100_s'], 's')}")
+    print(f"pool size:     min {fmt(summary['pool_min'])}, mean {fmt(summary['pool_mean'])} of {args.circuits} (after reaching 90%)")
+    print(f"circuits:      {sim.stats['launched']} launched, {sim.stats['built']} built, {sim.stats['failed']} failed, {sim.stats['collapsed']} collapsed, {sim.stats['closed']} closed")
+    print(f"exit subnets:  {summary['exit_subnets']} /{args.prefix_len} and {summary['exit_slash16']} /16 subnets over the {summary['pool_end']} circuits in the pool at the end ({summary['duplicate_subnets']} duplicates)")
+    print(f"ctrl calls:    {summary['ctrl_calls_per_s']}/s ({', '.join(f'{method} {n}' for method, n in summary['ctrl_calls'].items())})")
+
+    if args.json:
+        with open(args.json, "a") as f:
+            f.write(json.dumps(summary) + "\n")
+
+
+def fmt(value: Optional[float], unit: str = "") -> str:
+    return f"{value}{unit}" if value is not None else "n/a"
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(description="Discrete-event simulation of circus.py on a simulated clock and tor network, far faster than real time")
+    parser.add_argument("--consensus", metavar="FILE", help="tor cached-consensus / cached-microdesc-consensus or a circus snapshot (.json), default: generated consensus")
+    parser.add_argument("--relays", type=int, default=7000, help="relays in the generated consensus (default: %(default)s)")
+    parser.add_argument("--exit-ratio", type=float, default=0.25, help="fraction of exits in the generated consensus (default: %(default)s)")
+    parser.add_argument("--duration", type=float, default=3600, help="simulated seconds (default: %(default)s)")
+    parser.add_argument("--build-median", type=float, default=0.6, help="median circuit build time in seconds (default: %(default)s)")
+    parser.add_argument("--build-sigma", type=float, default=0.7, help="sigma of the log-normal build time (default: %(default)s)")
+    parser.add_argument("--build-failure-rate", type=float, default=0.1, help="probability of a circuit build failing (default: %(default)s)")
+    parser.add_argument("--collapse-rate", type=float, default=0.0, help="built circuits collapsing per circuit and hour (default: %(default)s)")
+    parser.add_argument("--host-ip", default="", help="IP circus weights guards against (default: none)")
+    parser.add_argument("--seed", type=int, help="random seed")
+    parser.add_argument("--json", metavar="FILE", help="append result summary as JSON line to FILE")
+    parser.add_argument("--circuits", type=int, default=1000, help="N_CIRCUITS (default: %(default)s)")
+    parser.add_argument("--circuit-ttl", type=int, default=180, help="CIRCUIT_TTL (default: %(default)s)")
+    parser.add_argument("--build-interval", type=int, default=5, help="BUILD_INTERVAL (default: %(default)s)")
+    parser.add_argument("--val-k", type=int, default=5, help="VAL_K, circuits built per step while filling the pool (default: %(default)s)")
+    parser.add_argument("--prefix-len", type=int, default=9, help="PREFIX_LEN (default: %(default)s)")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_args())
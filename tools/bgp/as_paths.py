@@ -3,25 +3,28 @@
 import json
 import random
 from argparse import Namespace, ArgumentParser
-from ipaddress import IPv4Network, AddressValueError, IPv6Network
-from multiprocessing import Pool
-from typing import List, Tuple
+from typing import List, Dict, Tuple, Set
 
-from pybgpsim import CaidaReader, Graph, GraphSearch
+import numpy as np
+from scipy.sparse import csr_matrix
 from tqdm import tqdm
 
+from asn_daemon import open_pfx2as
+from routing import AsGraph, route_pairs
+
 asn_of = {}
-search = None
 pfx2as = None
 
+LOOKUP_BATCH_SIZE = 10000
+
 main_le_ip = "23.178.112.201"
 main_le_dns_ip = "23.178.112.201"
 le_val_ips = ["16.16.204.159", "3.129.25.162", "13.49.137.73", "18.116.242.194", "18.237.3.70", "13.60.83.241"]
 le_val_dns_ips = ["51.20.133.4", "47.129.12.135", "35.90.152.70", "18.117.157.226", "52.42.153.110", "34.217.90.242", "18.216.202.198", "16.170.207.16"]
 
 
-def main(applog: List[dict], caida: str, le_sub: bool = False, dns_sub: bool = False):
-    global search, pfx2as, asn_of
+def main(applog: List[dict], caida: str, le_sub: bool = False, dns_sub: bool = False, path_cache: str = None):
+    global pfx2as, asn_of
 
     src_ips, dest_ips = set(), set()
     asn_pairs = set()
@@ -34,28 +37,16 @@ def main(applog: List[dict], caida: str, le_sub: bool = False, dns_sub: bool = F
         for src, dest in entry["exit_target_pairs"]:
             src_ips.add(src)
             dest_ips.add(dest)
-            asn_of.setdefault(src, ip2asn(src))
-            asn_of.setdefault(dest, ip2asn(dest))
-            asn_pairs.add((asn_of[src], asn_of[dest]))
-
-    graph = Graph()
-    reader = CaidaReader(graph)
-    reader.ReadFile(caida)
-    search = GraphSearch(graph)
-
-    on_path_asns = {}
-    with Pool() as pool:
-        for result in list(tqdm(pool.imap(get_on_path_asns, asn_pairs, chunksize=100), total=len(asn_pairs), desc="paths", leave=True)):
-            on_path_asns.update(result)
 
-    on_path_perc = {}
-    for entry in tqdm(applog, desc="overlap"):
-        on_path_perc[entry["domain"]] = {}
+    lookup_asns(src_ips | dest_ips)
+    for entry in applog:
         for src, dest in entry["exit_target_pairs"]:
-            for asn in on_path_asns[(asn_of[src], asn_of[dest])]:
-                on_path_perc[entry["domain"]][asn] = on_path_perc[entry["domain"]].get(asn, 0) + 1 / len(entry["exit_target_pairs"])
+            asn_pairs.add((asn_of[src], asn_of[dest]))
+
+    paths = route_pairs(AsGraph.read_caida(caida), asn_pairs, path_cache=path_cache)
+    on_path_asns = {(src, dest): set(paths[(src, dest)]).union(set(paths[(dest, src)])) - {src, dest} for src, dest in asn_pairs}
 
-    overlap_metric = round(sum(sum(asns.values()) / max(1, len(asns)) for asns in on_path_perc.values()) / len(on_path_perc), ndigits=3)
+    overlap_metric, hist = path_overlap(applog, on_path_asns)
 
     print(f"domains:       {len({entry['domain'] for entry in applog})}")
     print(f"validators:    {len(src_ips)}")
@@ -63,64 +54,54 @@ def main(applog: List[dict], caida: str, le_sub: bool = False, dns_sub: bool = F
     print(f"paths:         {len(on_path_asns)}")
     print(f"overlap:       {overlap_metric}")
 
-    hist = {}
-    for domain, on_path in on_path_perc.items():
-        for asn, frac in on_path.items():
-            perc = round(frac, ndigits=1) * 100
-            hist[perc] = hist.get(perc, 0) + 1
-
     with open("path_overlap_hist.json", "w") as f:
         json.dump(hist, f)
 
 
-def get_on_path_asns(args: Tuple[int, int]) -> dict:
-    src, dest = args
-    return {(src, dest): set(search.GetPath(src, dest)).union(set(search.GetPath(dest, src))) - {src, dest}}
-
-
-def ip2asn(ip: str) -> int:
-    ip = ip.lstrip("[").rstrip("]")
-    try:
-        return ipv42asn(ip)
-    except AddressValueError:
-        return ipv62asn(ip)
-
-
-def ipv42asn(ip: str) -> int:
-    global pfx2as
-    try:
-        ipnet = IPv4Network(f"{ip}/{32}", strict=False)
-    except AddressValueError:
-        ipnet = IPv4Network(ip, strict=False)
+def path_overlap(applog: List[dict], on_path_asns: Dict[Tuple[int, int], Set[int]]) -> Tuple[float, Dict[float, int]]:
+    # per domain the fraction of its exit-target pairs each AS is on path of, as domain x pair weights times pair x AS incidence
+    pair_ids = {pair: i for i, pair in enumerate(on_path_asns)}
+    asn_ids = {}
+    rows, columns = [], []
+    for pair, asns in on_path_asns.items():
+        for asn in asns:
+            rows.append(pair_ids[pair])
+            columns.append(asn_ids.setdefault(asn, len(asn_ids)))
+    on_path = csr_matrix((np.ones(len(rows)), (rows, columns)), shape=(len(pair_ids), len(asn_ids)))
+
+    # the last entry of a domain counts
+    domain_entries = {entry["domain"]: entry for entry in applog}
+    rows, columns, weights = [], [], []
+    for i, entry in enumerate(domain_entries.values()):
+        for src, dest in entry["exit_target_pairs"]:
+            rows.append(i)
+            columns.append(pair_ids[(asn_of[src], asn_of[dest])])
+            weights.append(1 / len(entry["exit_target_pairs"]))
+    on_path_perc = csr_matrix((weights, (rows, columns)), shape=(len(domain_entries), len(pair_ids))) @ on_path
 
-    while ipnet != IPv4Network("0.0.0.0/0"):
-        try:
-            return pfx2as[ipnet][0]
-        except KeyError:
-            ipnet = ipnet.supernet()
-    return 0
+    n_asns = np.diff(on_path_perc.indptr)
+    overlap_metric = round(float(np.mean(np.asarray(on_path_perc.sum(axis=1)).ravel() / np.maximum(1, n_asns))), ndigits=3)
 
+    hist = {}
+    for frac, count in zip(*np.unique(on_path_perc.data, return_counts=True)):
+        perc = round(float(frac), ndigits=1) * 100
+        hist[perc] = hist.get(perc, 0) + int(count)
+    return overlap_metric, hist
 
-def ipv62asn(ip: str) -> int:
-    global pfx2as
-    try:
-        ipnet = IPv6Network(f"{ip}/{128}", strict=False)
-    except AddressValueError:
-        ipnet = IPv6Network(ip, strict=False)
 
-    while ipnet != IPv6Network("::/0"):
-        try:
-            return pfx2as[ipnet][0]
-        except KeyError:
-            ipnet = ipnet.supernet()
-    return 0
+def lookup_asns(ips: Set[str]):
+    # distinct IPs in batches, one asn_daemon.py round trip each
+    ips = [ip for ip in ips if ip not in asn_of]
+    for i in range(0, len(ips), LOOKUP_BATCH_SIZE):
+        asn_of.update(zip(ips[i:i + LOOKUP_BATCH_SIZE], pfx2as.lookup_many(ips[i:i + LOOKUP_BATCH_SIZE])))
 
 
 def parse_args() -> Namespace:
     parser = ArgumentParser(description="evaluate BGP distribution of applog data from tova container")
     parser.add_argument("files", metavar="APPDATA", type=read_jsonl, nargs="+", help="app.jsonl files to evaluate")
-    parser.add_argument("caida", metavar="CAIDA", help="CAIDA AS relationship file")
-    parser.add_argument("pfx2as", metavar="PREFIX2AS", type=read_pfx2as, help="CAIDA Prefix2AS file")
+    parser.add_argument("caida", metavar="CAIDA", help="CAIDA AS relationship file or compiled graph")
+    parser.add_argument("pfx2as", metavar="PREFIX2AS", type=open_pfx2as, help="CAIDA Prefix2AS file, compiled index or asn_daemon.py socket")
+    parser.add_argument("--path-cache", metavar="FILE", help="SQLite file caching AS paths across runs, keyed by CAIDA file content and ASN pair")
     parser.add_argument("--le-sub", action="store_true", default=False, help="replace validator IPs with Let's Encrypt IPs")
     parser.add_argument("--dns", action="store_true", default=False, help="do replacement with Let's Encrypt DNS resolver IPs")
     return parser.parse_args()
@@ -131,18 +112,6 @@ def read_jsonl(filename: str) -> List[dict]:
         return [json.loads(line.strip()) for line in f]
 
 
-def read_pfx2as(filename: str) -> dict:
-    pfx2as = {}
-    with open(filename) as f:
-        for line in f:
-            prefix, length, asns = line.strip().split()
-            try:
-                pfx2as[IPv4Network(f"{prefix}/{length}")] = [int(asn) for asn in asns.split("_")]
-            except (AddressValueError, ValueError):
-                pass
-    return pfx2as
-
-
 def read_lines(filename: str) -> List[str]:
     with open(filename) as f:
         return [line.strip() for line in f]
@@ -155,6 +124,6 @@ if __name__ == '__main__':
     pfx2as = args.pfx2as
 
     if applog:
-        main(applog, args.caida, args.le_sub, args.dns)
+        main(applog, args.caida, args.le_sub, args.dns, args.path_cache)
     else:
         print("empty input")
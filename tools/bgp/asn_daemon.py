@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+import json
+import os
+import socket
+import stat
+from argparse import Namespace, ArgumentParser
+from socketserver import ThreadingUnixStreamServer, StreamRequestHandler
+from time import time
+from typing import List, Union
+
+from lpm import PrefixTable, read_pfx2as
+
+DEFAULT_SOCKET = "/tmp/asn-daemon.sock"
+
+table = None
+
+
+class AsnClient:
+    # same lookup methods as PrefixTable, answered by a running asn_daemon.py
+    def __init__(self, path: str = DEFAULT_SOCKET):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.rfile = self.sock.makefile("rb")
+
+    def call(self, op: str, ips: List[str]) -> list:
+        self.sock.sendall((json.dumps({"op": op, "ips": ips}) + "\n").encode())
+        response = json.loads(self.rfile.readline())
+        if "error" in response:
+            raise ValueError(response["error"])
+        return response["result"]
+
+    def lookup(self, ip: str) -> List[int]:
+        return self.call("all", [ip])[0]
+
+    def lookup_asn(self, ip: str) -> int:
+        return self.call("first", [ip])[0]
+
+    def lookup_many(self, ips: List[str]) -> List[int]:
+        return self.call("first", list(ips))
+
+    def lookup_all(self, ips: List[str]) -> List[List[int]]:
+        return self.call("all", list(ips))
+
+    def __reduce__(self):
+        # Pool workers open their own connection
+        return AsnClient, (self.sock.getpeername(),)
+
+
+class LookupHandler(StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                if request["op"] == "first":
+                    response = {"result": table.lookup_many(request["ips"])}
+                elif request["op"] == "all":
+                    response = {"result": table.lookup_all(request["ips"])}
+                else:
+                    response = {"error": f"unknown op {request['op']}"}
+            except (ValueError, KeyError, TypeError) as e:
+                response = {"error": f"{e.__class__.__name__}: {e}"}
+            self.wfile.write((json.dumps(response) + "\n").encode())
+
+
+def open_pfx2as(source: str) -> Union[PrefixTable, AsnClient]:
+    # pfx2as file, compiled index or the socket of a running asn_daemon.py
+    if stat.S_ISSOCK(os.stat(source).st_mode):
+        return AsnClient(source)
+    return read_pfx2as(source)
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(description="Keep a prefix-to-AS table loaded and answer batched IP-to-ASN lookups over a unix socket "
+                                        "(ip2asn.py, as_paths.py and blocking_ases.py take the socket in place of the pfx2as file)")
+    parser.add_argument("pfx2as", metavar="PREFIX2AS", help="CAIDA Prefix2AS file or compiled index")
+    parser.add_argument("--socket", "-s", default=DEFAULT_SOCKET, help="unix socket to listen on (default: %(default)s)")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    start = time()
+    table = read_pfx2as(args.pfx2as)
+    print(f"loaded {args.pfx2as} in {round(time() - start, ndigits=1)}s")
+
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+    with ThreadingUnixStreamServer(args.socket, LookupHandler) as server:
+        server.daemon_threads = True
+        print(f"listening on {args.socket}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            os.remove(args.socket)
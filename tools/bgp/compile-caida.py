@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+from argparse import Namespace, ArgumentParser
+from os.path import getsize
+from time import time
+
+from routing import AsGraph, save_graph, load_graph
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(description="Compile a CAIDA AS relationship file into a binary CSR graph, "
+                                        "which as_paths.py and blocking_ases.py accept in place of the text file and open via mmap")
+    parser.add_argument("caida", metavar="CAIDA", help="CAIDA AS relationship file")
+    parser.add_argument("graph", metavar="GRAPH", help="graph file to write")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    start = time()
+    graph = AsGraph.read_caida(args.caida)
+    print(f"parsed {len(graph.asns)} ASes with {len(graph.customers[1])} provider-customer and {len(graph.peers[1]) // 2} peering links "
+          f"in {round(time() - start, ndigits=1)}s")
+    save_graph(graph, args.graph)
+
+    start = time()
+    load_graph(args.graph)
+    print(f"wrote {args.graph} ({round(getsize(args.graph) / 2**20, ndigits=1)} MiB, opens in {round((time() - start) * 1000, ndigits=2)}ms)")
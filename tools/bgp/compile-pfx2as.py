@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+from argparse import Namespace, ArgumentParser
+from os.path import getsize
+from time import time
+
+from lpm import read_pfx2as, save_index, load_index
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(description="Compile a prefix-to-AS mapping (CAIDA pfx2as or intified deagg-asns.py pfx2as.tsv) into a binary index, "
+                                        "which the ip2asn tools accept in place of the text file and open via mmap")
+    parser.add_argument("pfx2as", metavar="PREFIX2AS", help="prefix-to-AS mapping")
+    parser.add_argument("index", metavar="INDEX", help="index file to write")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    start = time()
+    table = read_pfx2as(args.pfx2as)
+    print(f"parsed {len(table.lengths)} prefixes into {len(table.v4_starts)} IPv4 and {len(table.v6_starts)} IPv6 intervals in {round(time() - start, ndigits=1)}s")
+    save_index(table, args.index)
+
+    start = time()
+    load_index(args.index)
+    print(f"wrote {args.index} ({round(getsize(args.index) / 2**20, ndigits=1)} MiB, opens in {round((time() - start) * 1000, ndigits=2)}ms)")
@@ -0,0 +1,58 @@
+import bz2
+import gzip
+import io
+import lzma
+import os
+import shutil
+import subprocess
+import sys
+from contextlib import contextmanager
+from typing import IO, Iterator, Optional
+
+MAGIC = [(b"\x1f\x8b", "gzip"), (b"BZh", "bzip2"), (b"\xfd7zXZ\x00", "xz"), (b"\x28\xb5\x2f\xfd", "zstd")]
+EXTENSIONS = {".gz": "gzip", ".bz2": "bzip2", ".xz": "xz", ".zst": "zstd"}
+
+# external decompressors run in their own process (multi-threaded ones first), the python modules are the fallback
+COMMANDS = {"gzip": [["pigz", "-dc"], ["gzip", "-dc"]], "bzip2": [["lbzip2", "-dc"], ["pbzip2", "-dc"], ["bzip2", "-dc"]],
+            "xz": [["xz", "-dc", "-T0"]], "zstd": [["zstd", "-dcq"]]}
+MODULES = {"gzip": gzip.open, "bzip2": bz2.open, "xz": lzma.open}
+
+
+def compression_of(filename: str) -> Optional[str]:
+    # pipes like bash process substitutions cannot be peeked into, only their name tells
+    if not os.path.isfile(filename):
+        return next((compression for extension, compression in EXTENSIONS.items() if filename.endswith(extension)), None)
+    with open(filename, "rb") as f:
+        head = f.read(6)
+    return next((compression for magic, compression in MAGIC if head.startswith(magic)), None)
+
+
+@contextmanager
+def open_input(filename: str, text: bool = True) -> Iterator[IO]:
+    # plain, gzip, bzip2, xz or zstd file (by magic bytes) or '-' for stdin, decompressed while it is read
+    if filename == "-":
+        yield sys.stdin if text else sys.stdin.buffer
+        return
+
+    compression = compression_of(filename)
+    process = None
+    if not compression:
+        f = open(filename, "rb")
+    elif command := next((command for command in COMMANDS[compression] if shutil.which(command[0])), None):
+        process = subprocess.Popen(command + [filename], stdout=subprocess.PIPE, bufsize=2**20)
+        f = process.stdout
+    elif compression in MODULES:
+        f = MODULES[compression](filename, "rb")
+    else:
+        raise OSError(f"no {compression} decompressor installed to read {filename}")
+
+    try:
+        yield io.TextIOWrapper(f) if text else f
+        # a decompressor that was read to the end has to have succeeded, one stopped early is just terminated
+        if process and not f.read(1) and process.wait() != 0:
+            raise OSError(f"{process.args[0]} failed to decompress {filename}")
+    finally:
+        f.close()
+        if process:
+            process.terminate()
+            process.wait()
@@ -1,15 +1,24 @@
 #!/usr/bin/env python3
 
-# pipe in bgpdump -m <file>.gz
+# pipe in bgpdump -m <file>.gz or pass the MRT RIB files with --mrt
 
 import re
 import subprocess
-import sys
+import tempfile
 from argparse import Namespace, ArgumentParser
-from typing import List, Tuple, Any, Set, Iterable
+from contextlib import nullcontext, ExitStack
+from heapq import merge
+from itertools import groupby, islice
+from multiprocessing import Pool
+from os.path import join, isfile
+from typing import List, Tuple, Any, Set, Iterable, Iterator, Dict, Optional
 
 from tqdm import tqdm
 
+from compressed import open_input, compression_of
+from edges2caida import read_caida, get_asn_rel
+from mrt import read_ribs
+
 
 def deaggregate_all_duplicate_hops(prefix_paths: List[Tuple[str, List[str]]]) -> List[Tuple[str, List[str]]]:
     for prefix, as_path in tqdm(prefix_paths, desc="deaggregating duplicate hops"):
@@ -30,42 +39,52 @@ def deaggregate_duplicate_hops(as_path: List[str]) -> List[str]:
     return as_path
 
 
-def deaggregate_origins(prefix_paths: List[Tuple[str, List[str]]]) -> List[Tuple[str, List[str]]]:
-    prefix_paths.sort(key=lambda x: list(reversed(x[1])))
-    trailer = 0
+def deaggregate_origins(prefix_paths: Iterable[Tuple[str, List[str]]], pool: Optional[Pool] = None, max_pending: int = 10000) -> Iterator[List[Tuple[str, List[str]]]]:
+    # prefix_paths must be sorted by origin, at most max_pending origin groups are held in memory at a time
+    groups = ((asn, list(group)) for asn, group in groupby(prefix_paths, key=lambda x: x[1][-1]))
+    if pool is None:
+        for asn, group in groups:
+            yield label_origins(asn, group, origin_labels((asn, group)))
+        return
 
-    for header in tqdm(range(len(prefix_paths)), total=len(prefix_paths), desc="deaggregating origins"):
-        if prefix_paths[header][1][-1] == prefix_paths[trailer][1][-1]:
-            continue
-        deaggregate_origin(asn=prefix_paths[trailer][1][-1], prefix_paths=prefix_paths[trailer:header])
-        trailer = header
+    pending = []
+    for asn, group in groups:
+        pending.append((asn, group))
+        if len(pending) >= max_pending:
+            yield from label_pending(pending, pool)
+            pending = []
+    yield from label_pending(pending, pool)
 
-    return prefix_paths
+
+def label_pending(pending: List[Tuple[str, List[Tuple[str, List[str]]]]], pool: Pool) -> Iterator[List[Tuple[str, List[str]]]]:
+    for (asn, group), labels in zip(pending, pool.imap(origin_labels, pending, chunksize=64)):
+        yield label_origins(asn, group, labels)
 
 
 def deaggregate_origin(asn: str, prefix_paths: List[Tuple[str, List[str]]]) -> List[Tuple[str, List[str]]]:
-    pfx2asns = prefix2asns(asn, prefix_paths)
+    return label_origins(asn, prefix_paths, origin_labels((asn, prefix_paths)))
 
-    asn2pfxs = {}
-    for p, a in pfx2asns.items():
-        asn2pfxs[tuple(a)] = asn2pfxs.setdefault(tuple(a), set()).union({p})
 
-    if len(asn2pfxs) > 1:
-        for i in range(len(prefix_paths)):
-            for j, pfxs in enumerate(asn2pfxs.values()):
-                if prefix_paths[i][0] in pfxs:
-                    replace_in_list(asn, asn + f"-o{j}", prefix_paths[i][1])
+def origin_labels(args: Tuple[str, List[Tuple[str, List[str]]]]) -> Dict[str, int]:
+    # prefixes reached through the same set of neighbors share a virtual origin, numbered in order of appearance
+    asn, prefix_paths = args
+    neighbor_sets = {}
+    labels = {prefix: neighbor_sets.setdefault(frozenset(neighbors), len(neighbor_sets)) for prefix, neighbors in prefix2asns(asn, prefix_paths).items()}
+    return labels if len(neighbor_sets) > 1 else {}
+
+
+def label_origins(asn: str, prefix_paths: List[Tuple[str, List[str]]], labels: Dict[str, int]) -> List[Tuple[str, List[str]]]:
+    if labels:
+        for prefix, as_path in prefix_paths:
+            replace_in_list(asn, asn + f"-o{labels[prefix]}", as_path)
     return prefix_paths
 
 
-def prefix2asns(asn: str, prefix_paths: List[Tuple[str, List[str]]]) -> dict:
+def prefix2asns(asn: str, prefix_paths: List[Tuple[str, List[str]]]) -> Dict[str, Set[str]]:
     pfx2asn = {}
     for prefix, as_path in prefix_paths:
         as_path = remove_all_of(asn, as_path)
-        try:
-            pfx2asn[prefix] = pfx2asn.setdefault(prefix, set()).union({as_path[-1]})
-        except IndexError:
-            pfx2asn[prefix] = pfx2asn.setdefault(prefix, set()).union({asn})
+        pfx2asn.setdefault(prefix, set()).add(as_path[-1] if as_path else asn)
     return pfx2asn
 
 
@@ -95,17 +114,50 @@ def parse_bgpdump_line(line: str) -> Tuple[str, List[str]]:
 def parse_args() -> Namespace:
     parser = ArgumentParser(description="Deaggregate originating ASNs based on AS path and individualize artificially lengthened AS paths. "
                                         "Note: should be post-processed with 'sort | uniq'.")
-    parser.add_argument("--bgpdump", "-b", default="-", help="file containing output of 'bgpdump -m <file>' (default: stdin)")
+    parser.add_argument("--bgpdump", "-b", default="-", help="file containing output of 'bgpdump -m <file>', may be compressed (default: stdin)")
+    parser.add_argument("--mrt", "-m", metavar="RIB", nargs="+", help="read TABLE_DUMP_V2 RIB files (plain or compressed) directly instead of bgpdump output")
     parser.add_argument("--edges-out", "-e", default="edges.tsv", help="write AS edges to specified file (default: %(default)s)")
     parser.add_argument("--pfx2as-out", "-p", default="pfx2as.tsv", help="write prefix-to-AS mapping to specified file (default: %(default)s)")
+    parser.add_argument("--caida", "-c", metavar="FILE", help="CAIDA AS relationship file, if given the edges are written as intified CAIDA file to --caida-out "
+                                                              "and the pfx2as file is intified (replaces sort | uniq, edges2caida.py and intify-vasns.py)")
+    parser.add_argument("--caida-out", default="intified_caida.txt", help="write the intified CAIDA file to specified file, only with --caida (default: %(default)s)")
     parser.add_argument("--raw", "-r", action="store_true", help="output deaggregated AS path per prefix without writing files")
+    parser.add_argument("--chunk-size", type=int, default=2000000, help="AS paths sorted in memory before spilling to a temporary file (default: %(default)s)")
+    parser.add_argument("--tmp-dir", help="directory for the sorted chunks (default: system temp directory)")
+    parser.add_argument("--processes", type=int, help="processes deaggregating origin groups in parallel (default: all cores)")
     return parser.parse_args()
 
 
-def parse_lines(source: str) -> List[Tuple[str, List[str]]]:
-    lines = sys.stdin if source == "-" else open(source)
-    n_lines = None if args.bgpdump == "-" else get_line_count(args.bgpdump)
-    return [parse_bgpdump_line(line) for line in tqdm(lines, desc="parsing", total=n_lines)]
+def sort_by_origin(prefix_paths: Iterable[Tuple[str, List[str]]], chunk_size: int, tmp_dir: str) -> Iterator[Tuple[str, List[str]]]:
+    # external merge sort by reversed AS path, sorted chunks of chunk_size paths are spilled to tmp_dir
+    prefix_paths = iter(prefix_paths)
+    chunk_files = []
+    while chunk := list(islice(prefix_paths, chunk_size)):
+        chunk.sort(key=origin_first)
+        if not chunk_files and len(chunk) < chunk_size:
+            return iter(chunk)
+        chunk_files.append(write_chunk(chunk, join(tmp_dir, f"chunk-{len(chunk_files)}.tsv")))
+        del chunk
+
+    return merge(*(read_chunk(filename) for filename in chunk_files), key=origin_first)
+
+
+def origin_first(prefix_path: Tuple[str, List[str]]) -> List[str]:
+    return list(reversed(prefix_path[1]))
+
+
+def write_chunk(prefix_paths: List[Tuple[str, List[str]]], filename: str) -> str:
+    with open(filename, "w") as f:
+        for prefix, as_path in prefix_paths:
+            f.write(f"{prefix}\t{' '.join(as_path)}\n")
+    return filename
+
+
+def read_chunk(filename: str) -> Iterator[Tuple[str, List[str]]]:
+    with open(filename) as f:
+        for line in f:
+            prefix, as_path = line.rstrip("\n").split("\t")
+            yield prefix, as_path.split()
 
 
 def get_line_count(filename: str) -> int:
@@ -113,34 +165,77 @@ def get_line_count(filename: str) -> int:
     return int(p.stdout.decode().split()[0])
 
 
-def write_debug_output(prefix_paths: List[Tuple[str, List[str]]]):
-    for prefix, as_path in prefix_paths:
-        print(f"{prefix}\t{','.join(as_path)}")
+def write_debug_output(origin_groups: Iterable[List[Tuple[str, List[str]]]]):
+    for prefix_paths in origin_groups:
+        for prefix, as_path in prefix_paths:
+            print(f"{prefix}\t{','.join(as_path)}")
 
 
-def write_output(edges_file: str, pfx2as_file: str, prefix_paths: List[Tuple[str, List[str]]]):
+def write_output(edges_file: str, pfx2as_file: str, origin_groups: Iterable[List[Tuple[str, List[str]]]]):
     with open(edges_file, "w") as f_edges:
         with open(pfx2as_file, "w") as f_pfx2as:
-            for prefix, as_path in tqdm(prefix_paths, desc="writing edges & prefix2as mapping"):
+            for prefix_paths in origin_groups:
+                for prefix, as_path in prefix_paths:
+
+                    f_pfx2as.write("\t".join(prefix.split("/") + as_path[-1:]) + "\n")
+
+                    for i in range(len(as_path) - 1):
+                        f_edges.write("\t".join(as_path[i:i + 2]) + "\n")
+
 
-                f_pfx2as.write("\t".join(prefix.split("/") + as_path[-1:]) + "\n")
+def write_graph(caida_file: str, caida: Dict[Tuple[int, int], int], pfx2as_file: str, origin_groups: Iterable[List[Tuple[str, List[str]]]]):
+    # virtual ASNs are numbered from 1 in order of appearance, edges are kept as one integer per pair to deduplicate them in memory
+    ids = {}
+    edges = set()
+    with open(pfx2as_file, "w") as f_pfx2as:
+        for prefix_paths in origin_groups:
+            pfx2as = set()
+            for prefix, as_path in prefix_paths:
+                path_ids = [ids.setdefault(vasn, len(ids) + 1) for vasn in as_path]
+                pfx2as.add((prefix, path_ids[-1]))
+                edges.update(path_ids[i] << 32 | path_ids[i + 1] for i in range(len(path_ids) - 1))
 
-                for i in range(len(as_path) - 1):
-                    f_edges.write("\t".join(as_path[i:i + 2]) + "\n")
+            for prefix, asn in sorted(pfx2as):
+                f_pfx2as.write("\t".join(prefix.split("/") + [str(asn)]) + "\n")
+
+    asns = [0] * (len(ids) + 1)
+    for vasn, i in ids.items():
+        asns[i] = int(vasn.split("-")[0])
+    del ids
+
+    with open(caida_file, "w") as f_caida:
+        for edge in tqdm(sorted(edges), desc="applying CAIDA relationships"):
+            asn1, asn2 = edge >> 32, edge & 0xffffffff
+            rel = get_asn_rel(caida, asns[asn1], asns[asn2])
+            if rel == -2:
+                asn2, asn1 = (asn1, asn2)
+            f_caida.write(f"{asn1}|{asn2}|{rel}|bgp\n")
 
 
 if __name__ == '__main__':
     args = parse_args()
 
-    lines = sys.stdin if args.bgpdump == "-" else open(args.bgpdump)
-    prefix_paths = parse_lines(args.bgpdump)
-    lines.close()
+    caida = read_caida(args.caida) if args.caida else None
+
+    with ExitStack() as stack:
+        if args.mrt:
+            n_lines = None
+            records = read_ribs(args.mrt)
+        else:
+            n_lines = get_line_count(args.bgpdump) if isfile(args.bgpdump) and not compression_of(args.bgpdump) else None
+            records = map(parse_bgpdump_line, stack.enter_context(open_input(args.bgpdump)))
+
+        tmp_dir = stack.enter_context(tempfile.TemporaryDirectory(dir=args.tmp_dir))
+        prefix_paths = sort_by_origin(tqdm(records, desc="parsing", total=n_lines), args.chunk_size, tmp_dir)
+        with Pool(args.processes) if args.processes != 1 else nullcontext() as pool:
+            origin_groups = deaggregate_origins(tqdm(prefix_paths, desc="deaggregating origins", total=n_lines), pool)
+            # deaggregate_all_duplicate_hops(prefix_paths)
 
-    deaggregate_origins(prefix_paths)
-    # deaggregate_all_duplicate_hops(prefix_paths)
+            if args.raw:
+                write_debug_output(origin_groups)
 
-    if args.raw:
-        write_debug_output(prefix_paths)
+            elif args.caida:
+                write_graph(caida_file=args.caida_out, caida=caida, pfx2as_file=args.pfx2as_out, origin_groups=origin_groups)
 
-    else:
-        write_output(edges_file=args.edges_out, pfx2as_file=args.pfx2as_out, prefix_paths=prefix_paths)
+            else:
+                write_output(edges_file=args.edges_out, pfx2as_file=args.pfx2as_out, origin_groups=origin_groups)
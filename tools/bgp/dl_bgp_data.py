@@ -1,54 +1,145 @@
 #!/usr/bin/env python3
 
+import json
+import os
 import re
 from argparse import Namespace, ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Tuple
+from os.path import join, exists, getsize, basename
+from threading import Lock
+from typing import Tuple, List
 
 import requests
 
+CHUNK_SIZE = 2**20
+MANIFEST = ".dl_manifest.json"
 
-def main():
+# ETag, Last-Modified and size of every downloaded file and of partial downloads, to resume them and skip unchanged files
+manifest = {}
+manifest_file = None
+manifest_lock = Lock()
+
+
+def main(out_dir: str, jobs: int) -> bool:
     today = datetime.today()
-    ripe_date_str = datetime.strftime(today, "%Y.%m")
-    caida_date_str = datetime.strftime(today, "%Y/%m")
+    read_manifest(join(out_dir, MANIFEST))
+
+    sources = get_sources(today)
+    with ThreadPoolExecutor(jobs) as executor:
+        downloads = [executor.submit(dl_latest_file, out_dir=out_dir, **source) for source in sources]
 
-    # BGP Dumps
-    dl_latest_file(base_url=f"https://data.ris.ripe.net/rrc00/{ripe_date_str}/", file_regex=r"bview.[0-9]{8}\.[0-9]{4}\.gz", file_prefix="rcc00_")
-    dl_latest_file(base_url=f"https://data.ris.ripe.net/rrc24/{ripe_date_str}/", file_regex=r"bview.[0-9]{8}\.[0-9]{4}\.gz", file_prefix="rcc24_")
-    dl_latest_file(base_url=f"https://data.ris.ripe.net/rrc25/{ripe_date_str}/", file_regex=r"bview.[0-9]{8}\.[0-9]{4}\.gz", file_prefix="rcc25_")
-    dl_latest_file(base_url=f"http://archive.routeviews.org/bgpdata/{ripe_date_str}/RIBS/", file_regex=r"rib.[0-9]{8}\.[0-9]{4}\.bz2")
-    # AS Relationships
-    dl_latest_file(base_url="https://data.caida.org/datasets/as-relationships/serial-2/", file_regex=r"[0-9]{8}\.as-rel2\.txt\.bz2", auth=("jens.friess@tu-darmstadt", "CaidaAlwaysIsDaAnswer"))
-    # Prefix2AS
-    dl_latest_file(base_url=f"https://publicdata.caida.org/datasets/routing/routeviews-prefix2as/{caida_date_str}/", file_regex=r"routeviews-rv2-[0-9]{8}-1200\.pfx2as\.gz")
+    failed = [(source, download.exception()) for source, download in zip(sources, downloads) if download.exception()]
+    for source, e in failed:
+        print(f"failed to download from {source['base_url']}: {e}")
+    return not failed
 
 
-def dl_latest_file(base_url: str, file_regex: str, file_prefix: str = "", auth: Tuple[str, str] = None):
+def get_sources(today: datetime) -> List[dict]:
+    ripe_date_str = datetime.strftime(today, "%Y.%m")
+    caida_date_str = datetime.strftime(today, "%Y/%m")
+    return [
+        # BGP Dumps
+        dict(base_url=f"https://data.ris.ripe.net/rrc00/{ripe_date_str}/", file_regex=r"bview.[0-9]{8}\.[0-9]{4}\.gz", file_prefix="rcc00_"),
+        dict(base_url=f"https://data.ris.ripe.net/rrc24/{ripe_date_str}/", file_regex=r"bview.[0-9]{8}\.[0-9]{4}\.gz", file_prefix="rcc24_"),
+        dict(base_url=f"https://data.ris.ripe.net/rrc25/{ripe_date_str}/", file_regex=r"bview.[0-9]{8}\.[0-9]{4}\.gz", file_prefix="rcc25_"),
+        dict(base_url=f"http://archive.routeviews.org/bgpdata/{ripe_date_str}/RIBS/", file_regex=r"rib.[0-9]{8}\.[0-9]{4}\.bz2"),
+        # AS Relationships
+        dict(base_url="https://data.caida.org/datasets/as-relationships/serial-2/", file_regex=r"[0-9]{8}\.as-rel2\.txt\.bz2", auth=("jens.friess@tu-darmstadt", "CaidaAlwaysIsDaAnswer")),
+        # Prefix2AS
+        dict(base_url=f"https://publicdata.caida.org/datasets/routing/routeviews-prefix2as/{caida_date_str}/", file_regex=r"routeviews-rv2-[0-9]{8}-1200\.pfx2as\.gz"),
+    ]
+
+
+def dl_latest_file(base_url: str, file_regex: str, out_dir: str = ".", file_prefix: str = "", auth: Tuple[str, str] = None):
     latest_file = find_latest_file(dir_url=base_url, file_regex=file_regex)
-    dl_file(url=base_url + latest_file, filename=file_prefix + latest_file, auth=auth)
+    dl_file(url=base_url + latest_file, filename=join(out_dir, file_prefix + latest_file), auth=auth)
 
 
 def dl_file(url: str, filename: str, auth: Tuple[str, str] = None):
-    print(f"downloading {url} into {filename}")
-    write_bytes(filename, requests.get(url, auth=auth).content)
+    # streams into <filename>.part, resumes a partial download of the same URL and skips files the server reports unchanged
+    part = filename + ".part"
+    known = manifest.get(basename(filename), {})
+    known_part = manifest.get(basename(part), {})
+
+    headers = {}
+    if exists(filename) and known.get("url") == url and getsize(filename) == known.get("size"):
+        if known.get("etag"):
+            headers["If-None-Match"] = known["etag"]
+        if known.get("last_modified"):
+            headers["If-Modified-Since"] = known["last_modified"]
+    if exists(part) and known_part.get("url") == url and (validator := known_part.get("etag") or known_part.get("last_modified")):
+        # If-Range makes the server send the whole file if it changed since the partial download
+        headers["Range"] = f"bytes={getsize(part)}-"
+        headers["If-Range"] = validator
+
+    with requests.get(url, auth=auth, headers=headers, stream=True, timeout=60) as response:
+        if response.status_code == 304:
+            print(f"{filename} is up to date")
+            return
+        if response.status_code == 416:
+            # the partial download is not a prefix of the file anymore
+            os.remove(part)
+            update_manifest(part, None)
+            return dl_file(url, filename, auth)
+        response.raise_for_status()
+
+        entry = {"url": url, "etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+        if response.status_code == 206:
+            size = int(response.headers["Content-Range"].rsplit("/", 1)[1])
+            print(f"resuming {url} into {filename} at {getsize(part)} of {size} bytes")
+            mode = "ab"
+        else:
+            size = int(response.headers["Content-Length"]) if "Content-Length" in response.headers else None
+            print(f"downloading {url} into {filename}")
+            mode = "wb"
+        update_manifest(part, {**entry, "size": size})
+
+        with open(part, mode) as f:
+            # raw bytes, a Content-Encoding must not be undone for the size check
+            for chunk in response.raw.stream(CHUNK_SIZE, decode_content=False):
+                f.write(chunk)
+
+    if size is not None and getsize(part) != size:
+        raise IOError(f"{filename}: received {getsize(part)} of {size} bytes, run again to resume")
+    os.replace(part, filename)
+    update_manifest(filename, {**entry, "size": getsize(filename)})
+    update_manifest(part, None)
 
 
 def find_latest_file(dir_url: str, file_regex: str) -> str:
-    html = requests.get(dir_url)
+    html = requests.get(dir_url, timeout=60)
+    html.raise_for_status()
     return sorted(re.findall(file_regex, html.text))[-1]
 
 
-def write_bytes(filename: str, content: bytes):
-    with open(filename, "wb") as f:
-        f.write(content)
+def read_manifest(filename: str):
+    global manifest, manifest_file
+    manifest_file = filename
+    if exists(filename):
+        with open(filename) as f:
+            manifest = json.load(f)
+
+
+def update_manifest(filename: str, entry: dict = None):
+    with manifest_lock:
+        if entry:
+            manifest[basename(filename)] = entry
+        else:
+            manifest.pop(basename(filename), None)
+        if manifest_file:
+            with open(manifest_file + ".tmp", "w") as f:
+                json.dump(manifest, f, indent=2)
+            os.replace(manifest_file + ".tmp", manifest_file)
 
 
 def parse_args() -> Namespace:
     parser = ArgumentParser(description="Downloads latest available CAIDA AS Relationship and Prefix2AS datasets.")
+    parser.add_argument("--out-dir", "-o", default=".", help="directory to download into, keeps the download manifest (default: %(default)s)")
+    parser.add_argument("--jobs", "-j", type=int, default=6, help="parallel downloads (default: %(default)s)")
     return parser.parse_args()
 
 
 if __name__ == '__main__':
-    parse_args()
-    main()
+    args = parse_args()
+    exit(0 if main(args.out_dir, args.jobs) else 1)
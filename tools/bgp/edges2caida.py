@@ -1,11 +1,12 @@
 #!/usr/bin/env python3
 import sys
 from argparse import Namespace, ArgumentParser
-from pathlib import Path
-from typing import List, Tuple, Dict
+from typing import Tuple, Dict, Iterator
 
 from tqdm import tqdm
 
+from compressed import open_input
+
 
 def parse_args() -> Namespace:
     parser = ArgumentParser(description="Apply CAIDA AS relationships to AS edges (resulting CAIDA file written to stdout)")
@@ -15,21 +16,25 @@ def parse_args() -> Namespace:
 
 
 def read_caida(filename: str) -> Dict[Tuple[int, int], int]:
-    return {(int(asn1), int(asn2)): int(rel) for line in read_lines(filename) if not line.startswith("#") for asn1, asn2, rel, _ in [line.split("|")]}
+    with open_input(filename) as f:
+        return {(int(asn1), int(asn2)): int(rel) for line in f if not line.startswith("#") for asn1, asn2, rel, _ in [line.rstrip("\n").split("|")]}
 
 
-def read_edges(filename: str) -> List[Tuple[str, ...]]:
-    return [tuple(line.split()) for line in read_lines(filename)]
+def read_edges(filename: str) -> Iterator[Tuple[str, ...]]:
+    return (tuple(line.split()) for line in read_lines(filename))
 
 
-def read_lines(filename: str) -> List[str]:
-    return Path(filename).read_text().split("\n")[:-1]
+def read_lines(filename: str) -> Iterator[str]:
+    with open_input(filename) as f:
+        for line in f:
+            yield line.rstrip("\n")
 
 
 def get_rel(caida: Dict[Tuple[int, int], int], vasn1: str, vasn2: str) -> int:
-    asn1 = int(vasn1.split("-")[0])
-    asn2 = int(vasn2.split("-")[0])
+    return get_asn_rel(caida, int(vasn1.split("-")[0]), int(vasn2.split("-")[0]))
+
 
+def get_asn_rel(caida: Dict[Tuple[int, int], int], asn1: int, asn2: int) -> int:
     if asn1 == asn2:
         return 0
     try:
@@ -1,24 +1,42 @@
 #!/usr/bin/env python3
 import sys
 from argparse import Namespace, ArgumentParser
-from os.path import basename
-from pathlib import Path
-from typing import List
+from os.path import basename, isfile
+from typing import List, Iterator, Iterable, Callable
+
+from compressed import open_input, EXTENSIONS
 
 
 def parse_args() -> Namespace:
     parser = ArgumentParser(description="Map deaggregated ASN strings to virtual ASN integers (writes 'intified' CAIDA and pfx2as files)")
-    parser.add_argument("--pfx2as", "-p", metavar="FILE", help="file containing prefix-to-AS mapping")
-    parser.add_argument("--caida", "-c", metavar="FILE", help="CAIDA AS relationship file")
+    parser.add_argument("--pfx2as", "-p", metavar="FILE", help="file containing prefix-to-AS mapping, may be compressed")
+    parser.add_argument("--caida", "-c", metavar="FILE", help="CAIDA AS relationship file, may be compressed")
     return parser.parse_args()
 
 
-def parse_fields(lines: List[str], split_char: str = None) -> List[List[str]]:
-    return [line.split(split_char) for line in lines]
+def parse_fields(lines: Iterator[str], split_char: str = None) -> Iterator[List[str]]:
+    return (line.split(split_char) for line in lines)
+
+
+def read_lines(filename: str) -> Iterator[str]:
+    with open_input(filename) as f:
+        for line in f:
+            yield line.rstrip("\n")
 
 
-def read_lines(filename: str) -> List[str]:
-    return Path(filename).read_text().split("\n")[:-1]
+def rereadable_lines(filename: str) -> Callable[[], Iterable[str]]:
+    # regular files are streamed again for the second pass, pipes and stdin can only be read once and are kept in memory
+    if isfile(filename):
+        return lambda: read_lines(filename)
+    lines = list(read_lines(filename))
+    return lambda: lines
+
+
+def output_name(filename: str) -> str:
+    # the intified files are written uncompressed
+    for extension in EXTENSIONS:
+        filename = filename.removesuffix(extension)
+    return "intified_" + basename(filename)
 
 
 if __name__ == '__main__':
@@ -27,15 +45,20 @@ if __name__ == '__main__':
         print("no input (see --help)", file=sys.stderr)
         exit(1)
 
-    caida_lines = parse_fields(read_lines(args.caida), split_char="|") if args.caida else []
-    pfx2as_lines = parse_fields(read_lines(args.pfx2as)) if args.pfx2as else []
-
-    asns = {asn for line in caida_lines for asn in line[:2]}
-    asns = asns.union({line[-1] for line in pfx2as_lines})
+    # the inputs are read twice, once to collect the ASNs and once to write them intified
+    caida = rereadable_lines(args.caida) if args.caida else lambda: []
+    pfx2as = rereadable_lines(args.pfx2as) if args.pfx2as else lambda: []
+    asns = set()
+    asns.update(asn for line in parse_fields(caida(), split_char="|") for asn in line[:2])
+    asns.update(line[-1] for line in parse_fields(pfx2as()))
     intify = {asn: str(i + 1) for i, asn in enumerate(asns)}
 
     if args.caida:
-        Path("intified_" + basename(args.caida)).write_text("\n".join("|".join([intify[asn1], intify[asn2], rel, bgp]) for asn1, asn2, rel, bgp in caida_lines) + "\n")
+        with open(output_name(args.caida), "w") as f:
+            for asn1, asn2, rel, bgp in parse_fields(caida(), split_char="|"):
+                f.write("|".join([intify[asn1], intify[asn2], rel, bgp]) + "\n")
 
     if args.pfx2as:
-        Path("intified_" + basename(args.pfx2as)).write_text("\n".join("\t".join([prefix, prefix_len, intify[asn]]) for prefix, prefix_len, asn in pfx2as_lines) + "\n")
+        with open(output_name(args.pfx2as), "w") as f:
+            for prefix, prefix_len, asn in parse_fields(pfx2as()):
+                f.write("\t".join([prefix, prefix_len, intify[asn]]) + "\n")
@@ -0,0 +1,183 @@
+import mmap
+import socket
+import struct
+from bisect import bisect_right
+from typing import List, Iterable, Tuple
+
+import numpy as np
+
+from compressed import open_input
+
+Prefix = Tuple[int, int, List[int]]
+
+INDEX_MAGIC = b"PFX2AS\x00\x01"
+INDEX_HEADER = struct.Struct("<8sQQQQ")
+INDEX_ALIGN = 16
+
+
+class PrefixTable:
+    # longest prefix match over disjoint address intervals, each interval maps to the most specific prefix covering it
+    def __init__(self, v4_starts: np.ndarray, v4_ids: np.ndarray, v6_starts: np.ndarray, v6_ids: np.ndarray,
+                 lengths: np.ndarray, parents: np.ndarray, asn_offsets: np.ndarray, asn_values: np.ndarray, filename: str = None):
+        self.v4_starts = v4_starts
+        self.v4_ids = v4_ids
+        # numpy has no 128 bit integers, IPv6 interval starts are 16 byte big-endian strings, which sort like the addresses
+        self.v6_starts = v6_starts
+        self.v6_ids = v6_ids
+        self.lengths = lengths
+        self.parents = parents
+        # origin ASNs of prefix i are asn_values[asn_offsets[i]:asn_offsets[i + 1]]
+        self.asn_offsets = asn_offsets
+        self.asn_values = asn_values
+        self.first_asns = np.append(asn_values[asn_offsets[:-1]] if len(asn_values) else np.zeros(0, dtype=np.int64), 0)
+        self.filename = filename
+
+    def __reduce__(self):
+        # Pool workers map the index file themselves instead of receiving a copy of the arrays
+        if self.filename:
+            return load_index, (self.filename,)
+        return PrefixTable, tuple(self.arrays())
+
+    @classmethod
+    def build(cls, v4: Iterable[Prefix], v6: Iterable[Prefix]) -> "PrefixTable":
+        lengths, parents, asns = [], [], []
+        v4_starts, v4_ids = flatten(v4, 32, lengths, parents, asns)
+        v6_starts, v6_ids = flatten(v6, 128, lengths, parents, asns)
+        return cls(np.array(v4_starts, dtype=np.uint32), np.array(v4_ids, dtype=np.int32),
+                   np.array([start.to_bytes(16, "big") for start in v6_starts], dtype="S16"), np.array(v6_ids, dtype=np.int32),
+                   np.array(lengths, dtype=np.uint8), np.array(parents, dtype=np.int32),
+                   np.cumsum([0] + [len(a) for a in asns], dtype=np.int64), np.array([asn for a in asns for asn in a], dtype=np.int64))
+
+    def arrays(self) -> List[np.ndarray]:
+        return [self.v4_starts, self.v4_ids, self.v6_starts, self.v6_ids, self.lengths, self.parents, self.asn_offsets, self.asn_values]
+
+    def prefix_id(self, ip: str) -> int:
+        ip, _, length = ip.strip().lstrip("[").rstrip("]").partition("/")
+        if ":" in ip:
+            i = int(np.searchsorted(self.v6_starts, socket.inet_pton(socket.AF_INET6, ip), side="right")) - 1
+            prefix_id = int(self.v6_ids[i]) if i >= 0 else -1
+        else:
+            # bisect beats np.searchsorted's call overhead for single values
+            i = bisect_right(self.v4_starts, int.from_bytes(socket.inet_pton(socket.AF_INET, ip), "big")) - 1
+            prefix_id = int(self.v4_ids[i]) if i >= 0 else -1
+
+        # a network is only covered by prefixes at most as long as itself
+        while length and prefix_id != -1 and self.lengths[prefix_id] > int(length):
+            prefix_id = int(self.parents[prefix_id])
+        return prefix_id
+
+    def lookup(self, ip: str) -> List[int]:
+        try:
+            prefix_id = self.prefix_id(ip)
+        except OSError:
+            return []
+        return self.asn_values[self.asn_offsets[prefix_id]:self.asn_offsets[prefix_id + 1]].tolist() if prefix_id != -1 else []
+
+    def lookup_asn(self, ip: str) -> int:
+        try:
+            return int(self.first_asns[self.prefix_id(ip)])
+        except OSError:
+            return 0
+
+    def lookup_v4(self, addresses: np.ndarray) -> np.ndarray:
+        # batch lookup of IPv4 addresses as uint32, returns the first origin ASN or 0
+        i = np.searchsorted(self.v4_starts, addresses, side="right") - 1
+        ids = np.where(i >= 0, self.v4_ids[np.maximum(i, 0)], -1)
+        return self.first_asns[ids]
+
+    def lookup_many(self, ips: Iterable[str]) -> List[int]:
+        ips = list(ips)
+        v4 = [i for i, ip in enumerate(ips) if ":" not in ip and "/" not in ip]
+        asns = [0] * len(ips)
+        try:
+            addresses = np.array([int.from_bytes(socket.inet_pton(socket.AF_INET, ips[i].strip()), "big") for i in v4], dtype=np.uint32)
+            for i, asn in zip(v4, self.lookup_v4(addresses).tolist()):
+                asns[i] = asn
+        except OSError:
+            v4 = []
+        for i in set(range(len(ips))) - set(v4):
+            asns[i] = self.lookup_asn(ips[i])
+        return asns
+
+    def lookup_all(self, ips: Iterable[str]) -> List[List[int]]:
+        return [self.lookup(ip) for ip in ips]
+
+
+def flatten(prefixes: Iterable[Prefix], bits: int, lengths: List[int], parents: List[int], asns: List[List[int]]) -> Tuple[List[int], List[int]]:
+    unique = {}
+    for network, length, origins in prefixes:
+        unique[(network & ~((1 << (bits - length)) - 1), length)] = origins
+
+    starts, ids = [], []
+    stack = []
+
+    def emit(start: int, prefix_id: int):
+        if starts and starts[-1] == start:
+            ids[-1] = prefix_id
+        elif not ids or ids[-1] != prefix_id:
+            starts.append(start)
+            ids.append(prefix_id)
+
+    def pop_until(start: int):
+        while stack and stack[-1][0] < start:
+            end, _ = stack.pop()
+            if end + 1 < 1 << bits:
+                emit(end + 1, stack[-1][1] if stack else -1)
+
+    for (network, length), origins in sorted(unique.items()):
+        pop_until(network)
+        prefix_id = len(asns)
+        lengths.append(length)
+        parents.append(stack[-1][1] if stack else -1)
+        asns.append(origins)
+        stack.append((network + (1 << (bits - length)) - 1, prefix_id))
+        emit(network, prefix_id)
+    pop_until(1 << bits)
+    return starts, ids
+
+
+def parse_prefix(prefix: str, length: str) -> Tuple[bool, int, int]:
+    family = socket.AF_INET6 if ":" in prefix else socket.AF_INET
+    return family == socket.AF_INET6, int.from_bytes(socket.inet_pton(family, prefix), "big"), int(length)
+
+
+def read_pfx2as(filename: str) -> PrefixTable:
+    # (compressed) CAIDA routeviews pfx2as (multi-origin as 'asn_asn', AS sets as 'asn,asn'), intified deagg-asns.py pfx2as.tsv or a compiled index
+    with open(filename, "rb") as f:
+        if f.read(len(INDEX_MAGIC)) == INDEX_MAGIC:
+            return load_index(filename)
+
+    v4, v6 = [], []
+    with open_input(filename) as f:
+        for line in f:
+            try:
+                prefix, length, asns = line.strip().split()
+                is_v6, network, length = parse_prefix(prefix, length)
+                (v6 if is_v6 else v4).append((network, length, [int(asn) for asn in asns.replace(",", "_").split("_")]))
+            except (OSError, ValueError):
+                pass
+    return PrefixTable.build(v4, v6)
+
+
+def save_index(table: PrefixTable, filename: str):
+    with open(filename, "wb") as f:
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, len(table.v4_starts), len(table.v6_starts), len(table.lengths), len(table.asn_values)))
+        for array in table.arrays():
+            f.write(b"\x00" * (-f.tell() % INDEX_ALIGN))
+            f.write(np.ascontiguousarray(array).tobytes())
+
+
+def load_index(filename: str) -> PrefixTable:
+    # arrays are read-only views into the mapped file, so pages load lazily and are shared by all processes using the index
+    with open(filename, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    _, n_v4, n_v6, n_prefixes, n_asns = INDEX_HEADER.unpack_from(buffer)
+
+    offset = INDEX_HEADER.size
+    arrays = []
+    for dtype, count in [(np.uint32, n_v4), (np.int32, n_v4), ("S16", n_v6), (np.int32, n_v6),
+                         (np.uint8, n_prefixes), (np.int32, n_prefixes), (np.int64, n_prefixes + 1), (np.int64, n_asns)]:
+        offset += -offset % INDEX_ALIGN
+        arrays.append(np.frombuffer(buffer, dtype=dtype, count=count, offset=offset))
+        offset += arrays[-1].nbytes
+    return PrefixTable(*arrays, filename=filename)
@@ -0,0 +1,112 @@
+import socket
+import struct
+from itertools import islice
+from multiprocessing import Process, Queue
+from typing import List, Tuple, Iterator
+
+from compressed import open_input
+
+MRT_HEADER = struct.Struct(">IHHI")
+UINT16 = struct.Struct(">H")
+
+TABLE_DUMP_V2 = 13
+# RIB_IPV4_UNICAST, RIB_IPV4_MULTICAST, RIB_IPV6_UNICAST, RIB_IPV6_MULTICAST and their ADD-PATH variants (RFC 6396, RFC 8050)
+RIB_SUBTYPES = {2: (socket.AF_INET, False), 3: (socket.AF_INET, False), 4: (socket.AF_INET6, False), 5: (socket.AF_INET6, False),
+                8: (socket.AF_INET, True), 9: (socket.AF_INET, True), 10: (socket.AF_INET6, True), 11: (socket.AF_INET6, True)}
+
+ATTR_EXTENDED_LENGTH = 0x10
+ATTR_AS_PATH = 2
+AS_SEQUENCE = 2
+
+BATCH_SIZE = 10000
+
+
+def read_rib(filename: str) -> Iterator[Tuple[str, List[str]]]:
+    # (prefix, AS path) per RIB entry of a TABLE_DUMP_V2 file, the same records 'bgpdump -m' prints
+    with open_input(filename, text=False) as f:
+        while header := f.read(MRT_HEADER.size):
+            _, mrt_type, subtype, length = MRT_HEADER.unpack(header)
+            body = f.read(length)
+            if mrt_type == TABLE_DUMP_V2 and subtype in RIB_SUBTYPES:
+                yield from parse_rib(body, *RIB_SUBTYPES[subtype])
+
+
+def parse_rib(body: bytes, family: int, add_path: bool) -> Iterator[Tuple[str, List[str]]]:
+    prefix_length = body[4]
+    n_bytes = (prefix_length + 7) // 8
+    address = body[5:5 + n_bytes].ljust(4 if family == socket.AF_INET else 16, b"\x00")
+    prefix = f"{socket.inet_ntop(family, address)}/{prefix_length}"
+
+    offset = 5 + n_bytes
+    n_entries, = UINT16.unpack_from(body, offset)
+    offset += 2
+    for _ in range(n_entries):
+        # peer index, originated time and path identifier
+        offset += 10 if add_path else 6
+        attributes_length, = UINT16.unpack_from(body, offset)
+        offset += 2
+        as_path = parse_as_path(body, offset, offset + attributes_length)
+        offset += attributes_length
+        if as_path:
+            yield prefix, as_path
+
+
+def parse_as_path(body: bytes, offset: int, end: int) -> List[str]:
+    while offset < end:
+        flags, attr_type = body[offset], body[offset + 1]
+        if flags & ATTR_EXTENDED_LENGTH:
+            length, = UINT16.unpack_from(body, offset + 2)
+            offset += 4
+        else:
+            length = body[offset + 2]
+            offset += 3
+        if attr_type == ATTR_AS_PATH:
+            return parse_segments(body, offset, offset + length)
+        offset += length
+    return []
+
+
+def parse_segments(body: bytes, offset: int, end: int) -> List[str]:
+    # TABLE_DUMP_V2 always encodes 4 byte ASNs, the path ends at the first AS_SET or confederation segment like the bgpdump regex did
+    as_path = []
+    while offset < end:
+        segment_type, count = body[offset], body[offset + 1]
+        if segment_type != AS_SEQUENCE:
+            break
+        as_path.extend(map(str, struct.unpack_from(f">{count}I", body, offset + 2)))
+        offset += 2 + 4 * count
+    return as_path
+
+
+def read_ribs(filenames: List[str]) -> Iterator[Tuple[str, List[str]]]:
+    # several collectors are read and decompressed by one process each, records are interleaved in batches
+    if len(filenames) == 1:
+        yield from read_rib(filenames[0])
+        return
+
+    queue = Queue(maxsize=4 * len(filenames))
+    readers = [Process(target=queue_rib, args=(filename, queue), daemon=True) for filename in filenames]
+    for reader in readers:
+        reader.start()
+
+    remaining = len(readers)
+    while remaining:
+        batch = queue.get()
+        if batch is None:
+            remaining -= 1
+        elif isinstance(batch, Exception):
+            raise batch
+        else:
+            yield from batch
+    for reader in readers:
+        reader.join()
+
+
+def queue_rib(filename: str, queue: Queue):
+    try:
+        records = read_rib(filename)
+        while batch := list(islice(records, BATCH_SIZE)):
+            queue.put(batch)
+        queue.put(None)
+    except Exception as e:
+        queue.put(e)
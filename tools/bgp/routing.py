@@ -0,0 +1,235 @@
+import hashlib
+import mmap
+import sqlite3
+import struct
+from bisect import bisect_left
+from multiprocessing import Pool
+from typing import Dict, List, Set, Tuple, Iterable
+
+import numpy as np
+from tqdm import tqdm
+
+from compressed import open_input
+
+P2C = -1
+P2P = 0
+
+GRAPH_MAGIC = b"ASGRAPH\x01"
+GRAPH_HEADER = struct.Struct("<8s32sQQQQ")
+GRAPH_ALIGN = 16
+
+graph = None
+cache_file = None
+cache = None
+
+
+class AsGraph:
+    # CSR adjacency per relationship type over AS indices, asns is sorted so index order is ASN order
+    def __init__(self, asns: np.ndarray, customer_offsets: np.ndarray, customers: np.ndarray, peer_offsets: np.ndarray, peers: np.ndarray,
+                 provider_offsets: np.ndarray, providers: np.ndarray, digest: str, filename: str = None):
+        self.asns = asns
+        self.customers = (customer_offsets, customers)
+        self.peers = (peer_offsets, peers)
+        self.providers = (provider_offsets, providers)
+        # SHA-256 of the CAIDA text file, also kept by compiled graphs
+        self.digest = digest
+        self.filename = filename
+
+    def __reduce__(self):
+        if self.filename:
+            return load_graph, (self.filename,)
+        return AsGraph, tuple(self.arrays()) + (self.digest,)
+
+    @classmethod
+    def read_caida(cls, filename: str) -> "AsGraph":
+        # (compressed) CAIDA AS relationships ('<provider>|<customer>|-1' and '<peer>|<peer>|0') or a graph compiled by compile-caida.py
+        with open(filename, "rb") as f:
+            if f.read(len(GRAPH_MAGIC)) == GRAPH_MAGIC:
+                return load_graph(filename)
+
+        p2c, p2p = [], []
+        digest = hashlib.sha256()
+        with open_input(filename, text=False) as f:
+            for line in f:
+                digest.update(line)
+                if not line.startswith(b"#"):
+                    asn1, asn2, rel = line.split(b"|")[:3]
+                    if int(rel) == P2C:
+                        p2c.append((int(asn1), int(asn2)))
+                    elif int(rel) == P2P:
+                        p2p.append((int(asn1), int(asn2)))
+
+        p2c = np.array(p2c, dtype=np.int64).reshape(-1, 2)
+        p2p = np.array(p2p, dtype=np.int64).reshape(-1, 2)
+        asns = np.unique(np.concatenate([p2c.ravel(), p2p.ravel()]))
+        p2c = np.searchsorted(asns, p2c)
+        p2p = np.searchsorted(asns, p2p)
+        return cls(asns, *csr(len(asns), p2c[:, 0], p2c[:, 1]), *csr(len(asns), np.concatenate([p2p[:, 0], p2p[:, 1]]), np.concatenate([p2p[:, 1], p2p[:, 0]])),
+                   *csr(len(asns), p2c[:, 1], p2c[:, 0]), digest=digest.hexdigest())
+
+    def arrays(self) -> List[np.ndarray]:
+        return [self.asns, *self.customers, *self.peers, *self.providers]
+
+    def index(self, asn: int) -> int:
+        # bisect beats np.searchsorted's call overhead for single values
+        i = bisect_left(self.asns, asn)
+        return i if i < len(self.asns) and self.asns[i] == asn else -1
+
+
+class RoutingTree:
+    def __init__(self, as_graph: AsGraph, dest: int, next_hops: np.ndarray):
+        self.graph = as_graph
+        self.dest = dest
+        # next hop index of every AS index towards dest, -1 without route
+        self.next_hops = next_hops
+
+    def path(self, src: int) -> List[int]:
+        # AS path from src to dest including both, empty if src has no route
+        if src == self.dest:
+            return [src]
+        i = self.graph.index(src)
+        if i == -1 or self.next_hops[i] == -1:
+            return []
+        path = [src]
+        while path[-1] != self.dest:
+            i = self.next_hops[i]
+            path.append(int(self.graph.asns[i]))
+        return path
+
+
+class PathCache:
+    # AS paths keyed by the content hash of the CAIDA file they were computed on, SQLite lets concurrent processes share the file
+    def __init__(self, filename: str, topology: str):
+        self.topology = topology
+        self.db = sqlite3.connect(filename, timeout=60)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS paths (topology TEXT, dest INTEGER, src INTEGER, path TEXT, PRIMARY KEY (topology, dest, src)) WITHOUT ROWID")
+
+    def get(self, dest: int, srcs: Set[int]) -> Dict[Tuple[int, int], List[int]]:
+        rows = self.db.execute("SELECT src, path FROM paths WHERE topology = ? AND dest = ?", (self.topology, dest))
+        return {(src, dest): [int(asn) for asn in path.split()] for src, path in rows if src in srcs}
+
+    def put(self, paths: Dict[Tuple[int, int], List[int]]):
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO paths VALUES (?, ?, ?, ?)",
+                                [(self.topology, dest, src, " ".join(map(str, path))) for (src, dest), path in paths.items()])
+
+
+def csr(n: int, rows: np.ndarray, columns: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    order = np.lexsort((columns, rows))
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n), out=offsets[1:])
+    return offsets, columns[order].astype(np.int32)
+
+
+def neighbors_of(adjacency: Tuple[np.ndarray, np.ndarray], nodes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # all (neighbor, node) pairs of the CSR rows of nodes
+    offsets, neighbors = adjacency
+    starts = offsets[nodes]
+    counts = offsets[nodes + 1] - starts
+    row_starts = np.repeat(starts - (np.cumsum(counts) - counts), counts)
+    return neighbors[np.arange(len(row_starts)) + row_starts], np.repeat(nodes, counts)
+
+
+def best_routes(candidates: np.ndarray, via: np.ndarray, lengths: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # per AS without route the offer with the shortest path, then the lowest next hop
+    unrouted = lengths[candidates] == -1
+    candidates, via = candidates[unrouted], via[unrouted]
+    order = np.lexsort((via, lengths[via], candidates))
+    candidates, via = candidates[order], via[order]
+    first = np.ones(len(candidates), dtype=bool)
+    first[1:] = candidates[1:] != candidates[:-1]
+    return candidates[first], via[first]
+
+
+def routing_tree(as_graph: AsGraph, dest: int) -> RoutingTree:
+    # Gao-Rexford propagation of dest's announcement: customer routes are preferred over peer routes over provider routes,
+    # then shorter paths, then the lower next hop ASN; routes learned from peers or providers are only exported to customers
+    lengths = np.full(len(as_graph.asns), -1, dtype=np.int32)
+    next_hops = np.full(len(as_graph.asns), -1, dtype=np.int32)
+    dest_index = as_graph.index(dest)
+    if dest_index == -1:
+        return RoutingTree(as_graph, dest, next_hops)
+    lengths[dest_index] = 0
+    next_hops[dest_index] = dest_index
+
+    frontier = np.array([dest_index])
+    while len(frontier):
+        frontier, via = best_routes(*neighbors_of(as_graph.providers, frontier), lengths)
+        lengths[frontier] = lengths[via] + 1
+        next_hops[frontier] = via
+
+    peers, via = best_routes(*neighbors_of(as_graph.peers, np.flatnonzero(lengths != -1)), lengths)
+    lengths[peers] = lengths[via] + 1
+    next_hops[peers] = via
+
+    length = 0
+    while length <= lengths.max():
+        customers, via = best_routes(*neighbors_of(as_graph.customers, np.flatnonzero(lengths == length)), lengths)
+        lengths[customers] = length + 1
+        next_hops[customers] = via
+        length += 1
+
+    return RoutingTree(as_graph, dest, next_hops)
+
+
+def get_paths(args: Tuple[int, Set[int]]) -> Dict[Tuple[int, int], List[int]]:
+    global cache
+    dest, srcs = args
+    if cache_file and not cache:
+        # one connection per worker process
+        cache = PathCache(cache_file, graph.digest)
+
+    paths = cache.get(dest, srcs) if cache else {}
+    if len(paths) < len(srcs):
+        tree = routing_tree(graph, dest)
+        new_paths = {(src, dest): tree.path(src) for src in srcs if (src, dest) not in paths}
+        if cache:
+            cache.put(new_paths)
+        paths.update(new_paths)
+    return paths
+
+
+def route_pairs(as_graph: AsGraph, pairs: Iterable[Tuple[int, int]], processes: int = None, path_cache: str = None) -> Dict[Tuple[int, int], List[int]]:
+    # paths in both directions of every pair, one routing tree per distinct destination instead of one search per path,
+    # with path_cache only for destinations with uncached pairs
+    global graph, cache_file
+    graph = as_graph
+    cache_file = path_cache
+
+    srcs_of = {}
+    for src, dest in pairs:
+        srcs_of.setdefault(dest, set()).add(src)
+        srcs_of.setdefault(src, set()).add(dest)
+
+    paths = {}
+    # forked workers share the graph arrays (or the mapped graph file) read-only
+    with Pool(processes) as pool:
+        for result in tqdm(pool.imap_unordered(get_paths, srcs_of.items(), chunksize=10), total=len(srcs_of), desc="routing trees", mininterval=5):
+            paths.update(result)
+    return paths
+
+
+def save_graph(as_graph: AsGraph, filename: str):
+    with open(filename, "wb") as f:
+        f.write(GRAPH_HEADER.pack(GRAPH_MAGIC, bytes.fromhex(as_graph.digest), len(as_graph.asns),
+                                  len(as_graph.customers[1]), len(as_graph.peers[1]), len(as_graph.providers[1])))
+        for array in as_graph.arrays():
+            f.write(b"\x00" * (-f.tell() % GRAPH_ALIGN))
+            f.write(np.ascontiguousarray(array).tobytes())
+
+
+def load_graph(filename: str) -> AsGraph:
+    # arrays are read-only views into the mapped file, shared by all processes using the graph
+    with open(filename, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    _, digest, n_asns, n_customers, n_peers, n_providers = GRAPH_HEADER.unpack_from(buffer)
+
+    offset = GRAPH_HEADER.size
+    arrays = []
+    for dtype, count in [(np.int64, n_asns), (np.int64, n_asns + 1), (np.int32, n_customers), (np.int64, n_asns + 1), (np.int32, n_peers),
+                         (np.int64, n_asns + 1), (np.int32, n_providers)]:
+        offset += -offset % GRAPH_ALIGN
+        arrays.append(np.frombuffer(buffer, dtype=dtype, count=count, offset=offset))
+        offset += arrays[-1].nbytes
+    return AsGraph(*arrays, digest=digest.hex(), filename=filename)
@@ -2,52 +2,72 @@
 
 import json
 from argparse import Namespace, ArgumentParser
-from ipaddress import IPv4Network, AddressValueError, IPv6Network
+from collections import Counter
+from itertools import islice
 from multiprocessing import Pool
 import random
-from typing import List, Tuple
+import sys
+from os.path import dirname, abspath, join
+from typing import List, Iterable, Iterator, Tuple, Dict
 
-from pybgpsim import CaidaReader, Graph, GraphSearch
 from tqdm import tqdm
 
 from plot import hist
 
+sys.path.insert(0, join(dirname(abspath(__file__)), "bgp"))
+from asn_daemon import open_pfx2as
+from routing import AsGraph, route_pairs
+
+COUNT_CHUNK_SIZE = 10000
+# app log entries whose new IPs are looked up together, one asn_daemon.py round trip per chunk
+LOOKUP_CHUNK_SIZE = 1000
+
 asn_of = {}
-search = None
 pfx2as = None
 dns = {}
+paths = {}
 
 
-def main(applog: List[dict], caida: str):
-    global search, pfx2as, asn_of
+def main(applog: Iterable[dict], caida: str, path_cache: str = None):
+    global pfx2as, asn_of, paths
 
-    asn_pairs = []
+    # identical (src ASN, dest ASN, error) results are only counted, path work depends on the distinct ones
+    asn_pairs = Counter()
     no_target_ip, total_results = 0, 0
     asn_type = {}
-    for entry in tqdm(applog, desc="ASN pairs", total=len(applog), mininterval=5):
-        for src, dest, result in entry["results"]:
-            total_results += 1
-            try:
-                asn_of.setdefault(src, ip2asn(src))
-                asn_of.setdefault(dest, ip2asn(dest or random.choice(dns[entry["domain"]]["ips"])))
-                asn_pairs.append((asn_of[src], asn_of[dest], any(f"requests.exceptions.{err}" in result for err in ["ConnectTimeout", "ConnectionError", "ReadTimeout"])))
-                asn_type[asn_of[src]] = "src"
-                asn_type[asn_of[dest]] = "dest"
-            except (KeyError, IndexError):
-                no_target_ip += 1
+    entries = iter(tqdm(applog, desc="ASN pairs", mininterval=5))
+    while chunk := list(islice(entries, LOOKUP_CHUNK_SIZE)):
+        results = []
+        for entry in chunk:
+            for src, dest, result in entry["results"]:
+                total_results += 1
+                try:
+                    target = dest or random.choice(dns[entry["domain"]]["ips"])
+                except (KeyError, IndexError):
+                    no_target_ip += 1
+                    continue
+                results.append((src, dest, target, any(f"requests.exceptions.{err}" in result for err in ["ConnectTimeout", "ConnectionError", "ReadTimeout"])))
+
+        lookup_asns([(src, src) for src, _, _, _ in results] + [(dest, target) for _, dest, target, _ in results])
+        for src, dest, _, err in results:
+            asn_pairs[(asn_of[src], asn_of[dest], err)] += 1
+            asn_type[asn_of[src]] = "src"
+            asn_type[asn_of[dest]] = "dest"
+
+    if not total_results:
+        print("empty input")
+        return
 
     print(f"no target IP found for {no_target_ip} ({round(100 * no_target_ip / total_results, ndigits=1)}%) requests, ignoring")
-    graph = Graph()
-    reader = CaidaReader(graph)
-    reader.ReadFile(caida)
-    search = GraphSearch(graph)
+    print(f"{total_results - no_target_ip} requests between {len(asn_pairs)} distinct ASN pairs and outcomes")
+    paths = route_pairs(AsGraph.read_caida(caida), {(src, dest) for src, dest, _ in asn_pairs}, path_cache=path_cache)
 
     asn_counts = {}
+    weighted_pairs = list(asn_pairs.items())
+    chunks = [weighted_pairs[i:i + COUNT_CHUNK_SIZE] for i in range(0, len(weighted_pairs), COUNT_CHUNK_SIZE)]
     with Pool() as pool:
-        for result in list(tqdm(pool.imap(get_path_asns, asn_pairs, chunksize=100), total=len(asn_pairs), desc="paths", leave=True, mininterval=10)):
-            for asn, err in result.items():
-                asn_counts.setdefault(asn, {"err": 0, "ok": 0})
-                asn_counts[asn]["err" if err else "ok"] += 1
+        for counts in tqdm(pool.imap_unordered(count_path_asns, chunks), total=len(chunks), desc="paths", mininterval=10):
+            add_counts(asn_counts, counts)
 
     for asn in asn_counts.keys():
         asn_counts[asn]["type"] = asn_type.get(asn, "transit")
@@ -62,73 +82,47 @@ def main(applog: List[dict], caida: str):
         print(asn, asn_type.get(asn, "transit"))
 
 
-def get_path_asns(args: Tuple[int, int, bool]) -> dict:
-    src, dest, err = args
-    return {asn: err for asn in set(search.GetPath(src, dest)).union(set(search.GetPath(dest, src))) - {src}}
-
-
-def ip2asn(ip: str) -> int:
-    ip = ip.lstrip("[").rstrip("]")
-    try:
-        return ipv42asn(ip)
-    except AddressValueError:
-        return ipv62asn(ip)
-
-
-def ipv42asn(ip: str) -> int:
-    global pfx2as
-    try:
-        ipnet = IPv4Network(f"{ip}/{32}", strict=False)
-    except AddressValueError:
-        ipnet = IPv4Network(ip, strict=False)
+def count_path_asns(weighted_pairs: List[Tuple[Tuple[int, int, bool], int]]) -> Dict[int, Dict[str, int]]:
+    # forked workers read the paths computed before the pool was created
+    asn_counts = {}
+    for (src, dest, err), count in weighted_pairs:
+        for asn in set(paths[(src, dest)]).union(set(paths[(dest, src)])) - {src}:
+            asn_counts.setdefault(asn, {"err": 0, "ok": 0})
+            asn_counts[asn]["err" if err else "ok"] += count
+    return asn_counts
 
-    while ipnet != IPv4Network("0.0.0.0/0"):
-        try:
-            return pfx2as[ipnet][0]
-        except KeyError:
-            ipnet = ipnet.supernet()
-    return 0
 
+def add_counts(asn_counts: Dict[int, Dict[str, int]], counts: Dict[int, Dict[str, int]]):
+    for asn, count in counts.items():
+        asn_counts.setdefault(asn, {"err": 0, "ok": 0})
+        asn_counts[asn]["err"] += count["err"]
+        asn_counts[asn]["ok"] += count["ok"]
 
-def ipv62asn(ip: str) -> int:
-    global pfx2as
-    try:
-        ipnet = IPv6Network(f"{ip}/{128}", strict=False)
-    except AddressValueError:
-        ipnet = IPv6Network(ip, strict=False)
 
-    while ipnet != IPv6Network("::/0"):
-        try:
-            return pfx2as[ipnet][0]
-        except KeyError:
-            ipnet = ipnet.supernet()
-    return 0
+def lookup_asns(ips: Iterable[Tuple[str, str]]):
+    # ASNs of the (key, IP) pairs whose key is not known yet, the first IP per key counts, in one batch
+    pending = {}
+    for key, ip in ips:
+        if key not in asn_of:
+            pending.setdefault(key, ip)
+    if pending:
+        asn_of.update(zip(pending, pfx2as.lookup_many(pending.values())))
 
 
 def parse_args() -> Namespace:
     parser = ArgumentParser(description="evaluate Tor blocking behavior of ASes")
-    parser.add_argument("files", metavar="APPDATA", type=read_jsonl, nargs="+", help="app.jsonl files to evaluate")
-    parser.add_argument("caida", metavar="CAIDA", help="CAIDA AS relationship file")
-    parser.add_argument("pfx2as", metavar="PREFIX2AS", type=read_pfx2as, help="CAIDA Prefix2AS file")
+    parser.add_argument("files", metavar="APPDATA", nargs="+", help="app.jsonl files to evaluate (read incrementally)")
+    parser.add_argument("caida", metavar="CAIDA", help="CAIDA AS relationship file or compiled graph")
+    parser.add_argument("pfx2as", metavar="PREFIX2AS", type=open_pfx2as, help="CAIDA Prefix2AS file, compiled index or asn_daemon.py socket")
+    parser.add_argument("--path-cache", metavar="FILE", help="SQLite file caching AS paths across runs, keyed by CAIDA file content and ASN pair")
     parser.add_argument("--dns", metavar="DNSJSON", type=read_json, nargs="+", default={}, help="dnslookup.py JSON output")
     return parser.parse_args()
 
 
-def read_jsonl(filename: str) -> List[dict]:
-    with open(filename) as f:
-        return [json.loads(line.strip()) for line in f]
-
-
-def read_pfx2as(filename: str) -> dict:
-    pfx2as = {}
+def read_jsonl(filename: str) -> Iterator[dict]:
     with open(filename) as f:
         for line in f:
-            prefix, length, asns = line.strip().split()
-            try:
-                pfx2as[IPv4Network(f"{prefix}/{length}")] = [int(asn) for asn in asns.split("_")]
-            except (AddressValueError, ValueError):
-                pass
-    return pfx2as
+            yield json.loads(line.strip())
 
 
 def read_lines(filename: str) -> List[str]:
@@ -144,12 +138,9 @@ def read_json(filename: str) -> dict:
 if __name__ == '__main__':
     print("loading...")
     args = parse_args()
-    applog = [entry for file in args.files for entry in file]
+    applog = (entry for filename in args.files for entry in read_jsonl(filename))
     pfx2as = args.pfx2as
     for table in args.dns:
         dns.update(table)
 
-    if applog:
-        main(applog, args.caida)
-    else:
-        print("empty input")
+    main(applog, args.caida, args.path_cache)
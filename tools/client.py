@@ -1,42 +1,157 @@
 #!/usr/bin/env python3
+import asyncio
+import json
+import random
 import sys
-from math import ceil
-from multiprocessing.pool import Pool, ThreadPool
-from time import sleep
+from argparse import Namespace, ArgumentParser
+from typing import List, Tuple, Iterable, Dict
 
-import requests
-import urllib3
-from requests import Timeout, ConnectionError
+import aiohttp
 from tqdm import tqdm
 
+# sub-buckets per power of two, relative error of recorded latencies is below 2 / SUB_BUCKETS
+SUB_BUCKETS = 2048
 
-server = "localhost"
 
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+class Histogram:
+    def __init__(self):
+        self.counts = {}
+        self.total = 0
+        self.max = 0
 
+    def record(self, seconds: float):
+        value = max(1, int(seconds * 1e6))
+        shift = max(0, value.bit_length() - SUB_BUCKETS.bit_length() + 1)
+        bucket = (shift, value >> shift)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.total += 1
+        self.max = max(self.max, value)
 
-def query(url: str):
-    attempt = 1
-    while attempt < 3:
-        try:
-            return requests.get(url, timeout=60, verify=False).status_code
-        except Timeout:
-            sleep(2**attempt)
-        except ConnectionError as e:
-            if "Connection aborted." in str(e):
-                sleep(2**attempt)
-        attempt += 1
-    return "failed"
+    def percentile(self, p: float) -> float:
+        if self.total == 0:
+            return 0.0
+        rank, seen = p / 100 * self.total, 0
+        for shift, sub_bucket in sorted(self.counts, key=lambda bucket: bucket[1] << bucket[0]):
+            seen += self.counts[(shift, sub_bucket)]
+            if seen >= rank:
+                # highest value equivalent to the bucket, like HdrHistogram
+                return min(self.max, ((sub_bucket + 1) << shift) - 1) / 1e6
+        return self.max / 1e6
 
 
-# pipe in domains list
-urls = [f"https://{server}/http/{line.split(',')[-1].strip() if ',' in line else line.strip()}/robots.txt" for line in sys.stdin]
-n = 150
-chunksize = min(max(10, ceil(0.01 * len(urls) / n)), 200)
+def main(args: Namespace):
+    domains = read_domains(sys.stdin, timestamps=args.arrival == "replay")
+    if args.arrival == "replay":
+        arrivals = replay_arrivals(domains, args.speed)
+    else:
+        arrivals = list(zip(arrival_times(args.arrival, args.rate, len(domains)), (domain for _, domain in domains)))
+    urls = [(t, f"{args.scheme}://{args.server}/{args.protocol}/{domain}/{args.challenge}") for t, domain in arrivals]
 
-with ThreadPool(n) as pool:
-    res = list(tqdm(pool.imap(query, urls, chunksize=chunksize), total=len(urls), leave=True))
+    histogram, results, duration = asyncio.run(run(urls, args.connections, args.timeout))
+    report(args, histogram, results, duration)
 
-print(f"total vals: {len(res)}")
-print(f"completed: {sum(1 for r in res if r == 200)}")
-print(f"failed: {sum(1 for r in res if r == 'failed')}")
+
+def read_domains(lines: Iterable[str], timestamps: bool = False) -> List[Tuple[float, str]]:
+    # one domain per line, or csv with the domain in the last column (and the timestamp in the first one when replaying)
+    domains = []
+    for line in lines:
+        fields = [field.strip() for field in line.split(",")]
+        if fields[-1]:
+            domains.append((float(fields[0]) if timestamps else 0.0, fields[-1]))
+    return domains
+
+
+def arrival_times(process: str, rate: float, n: int) -> List[float]:
+    times, t = [], 0.0
+    for _ in range(n):
+        times.append(t)
+        t += random.expovariate(rate) if process == "poisson" else 1 / rate
+    return times
+
+
+def replay_arrivals(domains: List[Tuple[float, str]], speed: float) -> List[Tuple[float, str]]:
+    domains = sorted(domains)
+    start = domains[0][0] if domains else 0
+    return [((t - start) / speed, domain) for t, domain in domains]
+
+
+async def run(urls: List[Tuple[float, str]], connections: int, timeout: int) -> Tuple[Histogram, Dict[str, int], float]:
+    histogram = Histogram()
+    results = {}
+    loop = asyncio.get_running_loop()
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=connections, ssl=False), timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        with tqdm(total=len(urls), leave=True) as prog:
+            start = loop.time()
+            tasks = []
+            for offset, url in urls:
+                delay = start + offset - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                tasks.append(asyncio.create_task(query(session, url, start + offset, histogram, results, prog)))
+            await asyncio.gather(*tasks)
+            duration = loop.time() - start
+
+    return histogram, results, duration
+
+
+async def query(session: aiohttp.ClientSession, url: str, scheduled: float, histogram: Histogram, results: Dict[str, int], prog: tqdm):
+    try:
+        async with session.get(url) as r:
+            await r.read()
+            result = str(r.status)
+    except asyncio.TimeoutError:
+        result = "timeout"
+    except aiohttp.ClientError as e:
+        result = e.__class__.__name__
+
+    # latency counts from the scheduled arrival, so queueing in front of a busy server is not hidden
+    histogram.record(asyncio.get_running_loop().time() - scheduled)
+    results[result] = results.get(result, 0) + 1
+    prog.update()
+
+
+def report(args: Namespace, histogram: Histogram, results: Dict[str, int], duration: float):
+    summary = {"requests": histogram.total,
+               "completed": results.get("200", 0),
+               "results": results,
+               "duration": round(duration, ndigits=3),
+               "throughput": round(results.get("200", 0) / duration, ndigits=2) if duration else 0,
+               **{f"p{str(p).replace('.', '')}": round(histogram.percentile(p), ndigits=3) for p in [50, 90, 99, 99.9]},
+               "max": round(histogram.max / 1e6, ndigits=3)}
+
+    print(f"total vals: {summary['requests']}")
+    print(f"completed: {summary['completed']}")
+    print(f"failed: {summary['requests'] - summary['completed']}")
+    for result, n in sorted(results.items()):
+        if result != "200":
+            print(f"  {result}: {n}")
+    print(f"throughput: {summary['throughput']} vals/s")
+    print(f"latency: p50 {summary['p50']}s, p90 {summary['p90']}s, p99 {summary['p99']}s, p999 {summary['p999']}s, max {summary['max']}s")
+
+    if args.json:
+        with open(args.json, "a") as f:
+            f.write(json.dumps(summary) + "\n")
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(description="Open-loop load generator for tova, pipe in domains (one per line or csv with the domain in the last column)")
+    parser.add_argument("--server", default="localhost", help="tova server (default: %(default)s)")
+    parser.add_argument("--scheme", choices=["http", "https"], default="https", help="scheme of the tova server, http for bench.py --serve (default: %(default)s)")
+    parser.add_argument("--protocol", choices=["http", "https"], default="http", help="challenge protocol (default: %(default)s)")
+    parser.add_argument("--challenge", default="robots.txt", help="challenge path (default: %(default)s)")
+    parser.add_argument("--arrival", choices=["constant", "poisson", "replay"], default="poisson",
+                        help="arrival process, replay takes the timestamp (seconds) from the first csv column (default: %(default)s)")
+    parser.add_argument("--rate", type=float, default=10, help="requests per second for constant and poisson arrivals (default: %(default)s)")
+    parser.add_argument("--speed", type=float, default=1, help="replay speed up factor (default: %(default)s)")
+    parser.add_argument("--connections", type=int, default=150, help="max open connections to the server (default: %(default)s)")
+    parser.add_argument("--timeout", type=int, default=60, help="request timeout in seconds (default: %(default)s)")
+    parser.add_argument("--seed", type=int, help="random seed for poisson arrivals")
+    parser.add_argument("--json", metavar="FILE", help="append result summary as JSON line to FILE")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    random.seed(args.seed)
+    main(args)
@@ -1,39 +1,155 @@
 #!/usr/bin/env python3
+import asyncio
+import hashlib
 import json
 import sys
-from threading import Thread
+from argparse import Namespace, ArgumentParser
+from math import ceil, log
 from time import time
 
-import requests
-import urllib3
+import aiohttp
 
-session = requests.Session()
-session.headers.update({"User-Agent": "CTQueueLoader"})
-session.verify = False
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 server_domain = "localhost"
+counters = {"ingested": 0, "deduplicated": 0, "submitted": 0, "failed": 0, "dropped": 0}
 
 
-def send_to_queue(domain: str):
-    try:
-        session.get(f"https://{server_domain}/http/{domain}/robots.txt", verify=False, timeout=30)
-    except:
-        pass
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float):
+        self.n_bits = ceil(-capacity * log(error_rate) / log(2) ** 2)
+        self.n_hashes = max(1, round(self.n_bits / capacity * log(2)))
+        self.bits = bytearray(ceil(self.n_bits / 8))
+
+    def positions(self, item: str):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little")
+        return ((h1 + i * h2) % self.n_bits for i in range(self.n_hashes))
+
+    def add(self, item: str):
+        for pos in self.positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self.positions(item))
+
+
+class RotatingBloomFilter:
+    # remembers items for at least one and at most two windows
+    def __init__(self, window: float, capacity: int, error_rate: float):
+        self.window = window
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.current = BloomFilter(capacity, error_rate)
+        self.previous = BloomFilter(capacity, error_rate)
+        self.rotated = time()
+
+    def add(self, item: str) -> bool:
+        if time() > self.rotated + self.window:
+            self.previous, self.current = self.current, BloomFilter(self.capacity, self.error_rate)
+            self.rotated = time()
+        if item in self.current or item in self.previous:
+            return False
+        self.current.add(item)
+        return True
+
+
+class RateLimiter:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
 
+async def main(args: Namespace):
+    queue = asyncio.Queue(maxsize=args.queue_size)
+    seen = RotatingBloomFilter(args.dedupe_window, args.dedupe_capacity, args.dedupe_error)
+    limiter = RateLimiter(args.rate, args.burst)
 
-def main():
-    for line in sys.stdin:
+    async with aiohttp.ClientSession(headers={"User-Agent": "CTQueueLoader"}, connector=aiohttp.TCPConnector(limit=args.workers, ssl=False),
+                                     timeout=aiohttp.ClientTimeout(total=30)) as session:
+        workers = [asyncio.create_task(send_to_queue(session, queue, limiter)) for _ in range(args.workers)]
+        stats = asyncio.create_task(export_counters(args.stats_interval))
+        try:
+            await ingest(queue, seen)
+            await queue.join()
+        finally:
+            for task in workers + [stats]:
+                task.cancel()
+            log_counters()
+
+
+async def ingest(queue: asyncio.Queue, seen: RotatingBloomFilter):
+    loop = asyncio.get_running_loop()
+    while line := await loop.run_in_executor(None, sys.stdin.readline):
         if "O=Let's Encrypt" in line and "PrecertLogEntry" in line:
             data = json.loads(line.strip())
             domains = {domain.lstrip("*.") for domain in data["data"]["leaf_cert"]["all_domains"]}
             for domain in domains:
-                Thread(target=send_to_queue, args=(domain,), daemon=True).start()
-                print(data["data"]["leaf_cert"]["not_before"], domain)
+                counters["ingested"] += 1
+                if not seen.add(domain):
+                    counters["deduplicated"] += 1
+                    continue
+                try:
+                    # never block the certstream reader, shed load instead
+                    queue.put_nowait(domain)
+                    print(data["data"]["leaf_cert"]["not_before"], domain)
+                except asyncio.QueueFull:
+                    counters["dropped"] += 1
+
+
+async def send_to_queue(session: aiohttp.ClientSession, queue: asyncio.Queue, limiter: RateLimiter):
+    while True:
+        domain = await queue.get()
+        try:
+            await limiter.acquire()
+            async with session.get(f"https://{server_domain}/http/{domain}/robots.txt") as r:
+                await r.read()
+            # tova answers every finished validation with 200, anything else (e.g. a gunicorn worker timeout) did not validate
+            counters["submitted" if 200 <= r.status < 300 else "failed"] += 1
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            counters["failed"] += 1
+        finally:
+            queue.task_done()
+
+
+async def export_counters(interval: int):
+    while True:
+        await asyncio.sleep(interval)
+        log_counters()
+
+
+def log_counters():
+    print(json.dumps({"time": time(), **counters}), file=sys.stderr, flush=True)
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(description="Submit Let's Encrypt precert domains from certstream json lines (stdin) to tova")
+    parser.add_argument("--workers", type=int, default=50, help="concurrent requests to tova (default: %(default)s)")
+    parser.add_argument("--queue-size", type=int, default=10000, help="domains waiting for a worker before new ones are dropped (default: %(default)s)")
+    parser.add_argument("--rate", type=float, default=20, help="max domains per second submitted to tova (default: %(default)s)")
+    parser.add_argument("--burst", type=int, default=50, help="rate limiter burst size (default: %(default)s)")
+    parser.add_argument("--dedupe-window", type=int, default=3600, help="seconds a domain is remembered at least (default: %(default)s)")
+    parser.add_argument("--dedupe-capacity", type=int, default=1000000, help="domains per dedupe window (default: %(default)s)")
+    parser.add_argument("--dedupe-error", type=float, default=0.001, help="false positive rate of the dedupe filter (default: %(default)s)")
+    parser.add_argument("--stats-interval", type=int, default=60, help="seconds between counter exports to stderr (default: %(default)s)")
+    return parser.parse_args()
 
 
 if __name__ == '__main__':
     print(f"start: {time()}")
     try:
-        main()
+        asyncio.run(main(parse_args()))
     except KeyboardInterrupt:
         print(f"end: {time()}")
@@ -1,27 +1,120 @@
 #!/usr/bin/env python3
+import sys
+from argparse import Namespace, ArgumentParser
 from ipaddress import IPv4Network
+from os.path import dirname, abspath, join
+from typing import List, Callable, Tuple
 
+import numpy as np
 import requests
+from scipy.sparse import csr_matrix
 from tqdm import tqdm
 
+sys.path.insert(0, join(dirname(abspath(__file__)), "bgp"))
+from asn_daemon import open_pfx2as
+from routing import AsGraph, routing_tree
 
-def overlap(net1: IPv4Network, net2: IPv4Network) -> int:
-    return 32 - (int(net1.network_address) ^ int(net2.network_address)).bit_length()
+N = 30
+LE_MAIN_NET = "23.178.112.0/24"
 
 
-N = 30
+def prefix_overlaps(nets: List[IPv4Network]) -> Callable[[int], np.ndarray]:
+    # overlap of all nets with net i: 32 minus the bit length of the XORed network addresses (frexp's exponent, exact for 32 bit integers)
+    addresses = np.array([int(net.network_address) for net in nets], dtype=np.uint32)
+    return lambda i: 32 - np.frexp((addresses ^ addresses[i]).astype(np.float64))[1]
+
+
+def as_path_overlaps(nets: List[IPv4Network], caida: str, pfx2as, targets: List[str]) -> Tuple[Callable[[int], np.ndarray], np.ndarray]:
+    # overlap of two nets is the number of ASes their routes towards each target AS share (except the target itself),
+    # nets x (target, AS) incidence times its row of net i; also returns which nets have a route at all
+    graph = AsGraph.read_caida(caida)
+    asns = [pfx2as.lookup_asn(str(net)) for net in nets]
+    target_asns = sorted({asn for asn in pfx2as.lookup_many(targets) if asn})
+
+    features = {}
+    rows, columns = [], []
+    for t, target in enumerate(tqdm(target_asns, desc="routing trees")):
+        tree = routing_tree(graph, target)
+        for i, asn in enumerate(asns):
+            for hop in tree.path(asn)[:-1] if asn else []:
+                rows.append(i)
+                columns.append(features.setdefault((t, hop), len(features)))
+
+    on_path = csr_matrix((np.ones(len(rows)), (rows, columns)), shape=(len(nets), len(features)))
+    routed = np.diff(on_path.indptr) > 0
+    return lambda i: (on_path @ on_path[i].T).toarray().ravel(), routed
+
+
+def select(n: int, overlaps: Callable[[int], np.ndarray], available: np.ndarray, start: List[int]) -> List[int]:
+    # greedy: the next net is the available one with the lowest overlap sum with all selected nets (first one on ties)
+    available = available.copy()
+    sums = np.zeros(len(available))
+    for i in start:
+        sums += overlaps(i)
+        available[i] = False
+
+    selected = list(start)
+    for _ in tqdm(range(len(start), n)):
+        if not available.any():
+            break
+        i = int(np.argmin(np.where(available, sums, np.inf)))
+        selected.append(i)
+        available[i] = False
+        sums += overlaps(i)
+    return selected
+
+
+def read_prefixes(filename: str) -> List[IPv4Network]:
+    # one IPv4 prefix or address per line, also 'prefix<TAB>length<TAB>...' as in pfx2as files; other lines are skipped
+    nets = []
+    with open(filename) as f:
+        for line in f:
+            fields = line.split()
+            try:
+                nets.append(IPv4Network(f"{fields[0]}/{fields[1]}" if len(fields) > 1 and fields[1].isdigit() else fields[0], strict=False))
+            except (ValueError, IndexError):
+                pass
+    return nets
+
+
+def read_ec2_prefixes() -> List[IPv4Network]:
+    aws_ip_ranges = requests.get("https://ip-ranges.amazonaws.com/ip-ranges.json").json()
+    return [IPv4Network(net["ip_prefix"]) for net in aws_ip_ranges["prefixes"] if net["service"] == "EC2"]
+
+
+def read_lines(filename: str) -> List[str]:
+    with open(filename) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(description="Greedily choose validator networks with the least overlap with the ones chosen before, "
+                                        "starting from the Let's Encrypt main network")
+    parser.add_argument("-n", type=int, default=N, help="number of networks including the start networks (default: %(default)s)")
+    parser.add_argument("--candidates", metavar="FILE", help="candidate prefixes or IPs, e.g. Tor exits or a pfx2as file (default: AWS EC2 prefixes)")
+    parser.add_argument("--start", nargs="+", default=[LE_MAIN_NET], help="networks selected up front (default: %(default)s)")
+    parser.add_argument("--caida", metavar="CAIDA", help="optimize AS path overlap towards --targets instead of prefix overlap, "
+                                                          "CAIDA AS relationship file or compiled graph")
+    parser.add_argument("--pfx2as", metavar="PREFIX2AS", type=open_pfx2as, help="CAIDA Prefix2AS file, compiled index or asn_daemon.py socket (with --caida)")
+    parser.add_argument("--targets", metavar="FILE", type=read_lines, help="target IPs the validators' routes lead to (with --caida)")
+    args = parser.parse_args()
+    if args.caida and not (args.pfx2as and args.targets):
+        parser.error("--caida requires --pfx2as and --targets")
+    return args
 
-aws_ip_ranges = requests.get("https://ip-ranges.amazonaws.com/ip-ranges.json").json()
-ec2_nets = [IPv4Network(net["ip_prefix"]) for net in aws_ip_ranges["prefixes"] if net["service"] == "EC2"]
 
-LE_main_net = IPv4Network("23.178.112.0/24")
-selected = [LE_main_net]
+if __name__ == '__main__':
+    args = parse_args()
+    candidates = read_prefixes(args.candidates) if args.candidates else read_ec2_prefixes()
+    nets = [IPv4Network(net, strict=False) for net in args.start] + candidates
+    start = list(range(len(args.start)))
 
-for _ in tqdm(list(range(1, N))):
-    overlaps = {new_net: [overlap(new_net, net) for net in selected] for new_net in ec2_nets}
-    new_net = sorted(overlaps.keys(), key=lambda x: sum(overlaps[x]) / len(overlaps[x]))[0]
-    selected.append(new_net)
-    ec2_nets.remove(new_net)
+    if args.caida:
+        overlaps, available = as_path_overlaps(nets, args.caida, args.pfx2as, args.targets)
+        print(f"{len(nets) - available.sum()} of {len(nets)} networks have no route to the targets and are skipped", file=sys.stderr)
+    else:
+        overlaps, available = prefix_overlaps(nets), np.ones(len(nets), dtype=bool)
 
-print("\n".join([str(next(net.hosts())) for net in selected]))
-print([str(next(net.hosts())) for net in selected])
+    selected = [nets[i] for i in select(args.n, overlaps, available, start)]
+    print("\n".join([str(next(iter(net.hosts()))) for net in selected]))
+    print([str(next(iter(net.hosts()))) for net in selected])
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+import asyncio
+import json
+from argparse import Namespace, ArgumentParser
+from heapq import merge
+from typing import Iterator
+
+from client import run, report
+
+
+def main(args: Namespace):
+    urls = []
+    start = None
+    for entry in merge(*(read_log(filename) for filename in args.logs), key=lambda x: x["req_start"]):
+        start = start if start is not None else entry["req_start"]
+        if args.limit and len(urls) >= args.limit:
+            break
+        # older logs don't record protocol and challenge
+        urls.append(((entry["req_start"] - start) / args.speed,
+                     f"{args.scheme}://{args.server}/{entry.get('protocol', args.protocol)}/{entry['domain']}/{entry.get('challenge', args.challenge)}"))
+
+    print(f"replaying {len(urls)} validations over {round(urls[-1][0] if urls else 0, ndigits=1)}s")
+    histogram, results, duration = asyncio.run(run(urls, args.connections, args.timeout))
+    report(args, histogram, results, duration)
+
+
+def read_log(filename: str) -> Iterator[dict]:
+    # every gunicorn worker writes its own log, one validation at a time, so each file is ordered by req_start
+    with open(filename) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if "req_start" in entry and "domain" in entry:
+                yield entry
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(description="Replay validations recorded in tova's app-<PID>.log files with their original timing")
+    parser.add_argument("logs", nargs="+", help="app-<PID>.log files of all workers")
+    parser.add_argument("--server", default="localhost", help="tova server (default: %(default)s)")
+    parser.add_argument("--scheme", choices=["http", "https"], default="https", help="scheme of the tova server, http for bench.py --serve (default: %(default)s)")
+    parser.add_argument("--speed", type=float, default=1, help="speed up factor of the inter-arrival times (default: %(default)s)")
+    parser.add_argument("--limit", type=int, help="replay only the first LIMIT validations")
+    parser.add_argument("--protocol", choices=["http", "https"], default="http", help="challenge protocol if not logged (default: %(default)s)")
+    parser.add_argument("--challenge", default="robots.txt", help="challenge path if not logged (default: %(default)s)")
+    parser.add_argument("--connections", type=int, default=150, help="max open connections to the server (default: %(default)s)")
+    parser.add_argument("--timeout", type=int, default=60, help="request timeout in seconds (default: %(default)s)")
+    parser.add_argument("--json", metavar="FILE", help="append result summary as JSON line to FILE")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_args())
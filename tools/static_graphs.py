@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 
+import numpy as np
 from scipy.special import binom
 
+from attack_success import tail_probability
 from plot import hist, plt, line
 
 
@@ -9,7 +11,7 @@ def main():
     scenarios = [(3, 4), (5, 7), (7, 9)]
     N = 2254
     x = list(range(500))
-    y = {f"k={k},n={n}": ([100 * prob(M, n, k, N) for M in x], [100 * sum(hypergeom(M, n, j, N) for j in range(k, n + 1)) for M in x]) for k, n in scenarios}
+    y = {f"k={k},n={n}": ((100 * prob(np.array(x), n, k, N)).tolist(), (100 * tail_probability(k, n, x, N)).tolist()) for k, n in scenarios}
 
     colors = plt.rcParams['axes.prop_cycle'].by_key()['color']
     for i, (label, (real_prob, hg_dist)) in enumerate(y.items()):
@@ -81,9 +83,5 @@ def prob(M: int, n: int, k: int, N: int):
     return sum(binom(k, j) * (M / N) ** k * (1 - M / N) ** (k - j) for j in range(k - (n - k), k + 1))
 
 
-def hypergeom(M: int, n: int, k: int, N: int):
-    return binom(M, k) * binom(N - M, n - k) / binom(N, n)
-
-
 if __name__ == '__main__':
     main()